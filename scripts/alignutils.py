@@ -0,0 +1,537 @@
+import os, sys, struct
+import numpy as np
+from optparse      import OptionParser
+from Bio           import AlignIO, SeqIO
+from Bio.Seq       import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.Align     import MultipleSeqAlignment
+
+####################################################################
+# Some functions for working with alignments as uint8 byte matrices #
+####################################################################
+#
+# Packed alignment format (.msapack):
+#   - 8 byte magic string
+#   - 3 little-endian uint64: number of sequences, number of columns, length of the id block
+#   - id block: utf-8 sequence ids separated by newlines
+#   - zero padding up to the next multiple of 64 bytes
+#   - (sequences x columns) uint8 matrix, row-major
+#
+# The matrix is memory-mapped when reading, so slicing rows and columns does not read the
+# rest of the file.
+#
+####################################################################
+
+PACKED_MAGIC  = b"MSAPACK1"
+PACKED_HEADER = "<QQQ"
+PACKED_ALIGN  = 64
+
+
+def readFastaMatrix(filename):
+    """Read a fasta alignment into a list of sequence ids and a (sequences x columns) uint8 matrix
+
+    Sequence ids are the first word of the header line (the same as Bio.SeqIO).
+    All sequences must have the same length.
+
+    """
+
+    ids   = []
+    seqs  = []
+    parts = None
+    with open(filename, "rb") as f:
+        for line in f:
+            if (line.startswith(b">")):
+                if (parts is not None):
+                    seqs.append(b"".join(parts))
+                header = line[1:].split(None, 1)
+                ids.append(header[0].decode() if len(header) > 0 else "")
+                parts = []
+            elif (parts is not None):
+                parts.append(line.strip())
+    if (parts is not None):
+        seqs.append(b"".join(parts))
+
+    if (len(seqs) == 0):
+        raise ValueError("No sequences found in %s" % filename)
+
+    ncols = len(seqs[0])
+    for i in range(0, len(seqs)):
+        if (len(seqs[i]) != ncols):
+            raise ValueError("Sequences in %s are not aligned (%s has length %d, expected %d)" % (filename, ids[i], len(seqs[i]), ncols))
+
+    matrix = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), ncols)
+
+    return (ids, matrix)
+#
+
+
+def writePackedAlignment(ids, matrix, filename):
+    """Write sequence ids and a uint8 alignment matrix to a packed alignment file
+
+    """
+
+    idblock = "\n".join(ids).encode()
+    header  = PACKED_MAGIC + struct.pack(PACKED_HEADER, matrix.shape[0], matrix.shape[1], len(idblock)) + idblock
+    padding = (PACKED_ALIGN - len(header) % PACKED_ALIGN) % PACKED_ALIGN
+
+    with open(filename, "wb") as f:
+        f.write(header)
+        f.write(b"\0"*padding)
+        f.write(np.ascontiguousarray(matrix, dtype=np.uint8).tobytes())
+#
+
+
+def isPackedAlignment(filename):
+    """Check if a file is a packed alignment
+
+    """
+
+    with open(filename, "rb") as f:
+        return (f.read(len(PACKED_MAGIC)) == PACKED_MAGIC)
+#
+
+
+def readPackedAlignment(filename):
+    """Read a packed alignment and return a list of sequence ids and a read-only memory-mapped
+    uint8 matrix of the characters
+
+    """
+
+    with open(filename, "rb") as f:
+        if (f.read(len(PACKED_MAGIC)) != PACKED_MAGIC):
+            raise ValueError("%s is not a packed alignment" % filename)
+        (nseqs, ncols, idlen) = struct.unpack(PACKED_HEADER, f.read(struct.calcsize(PACKED_HEADER)))
+        idblock = f.read(idlen)
+
+    ids    = idblock.decode().split("\n") if nseqs > 0 else []
+    offset = len(PACKED_MAGIC) + struct.calcsize(PACKED_HEADER) + idlen
+    offset += (PACKED_ALIGN - offset % PACKED_ALIGN) % PACKED_ALIGN
+    matrix = np.memmap(filename, dtype=np.uint8, mode="r", offset=offset, shape=(nseqs, ncols))
+
+    return (ids, matrix)
+#
+
+
+def readAlignmentMatrix(filename):
+    """Read an alignment (fasta or packed) and return a list of sequence ids and a uint8 matrix
+    of the characters
+
+    """
+
+    if (isPackedAlignment(filename)):
+        return readPackedAlignment(filename)
+    else:
+        return readFastaMatrix(filename)
+#
+
+
+def matrixToMSA(ids, matrix):
+    """Convert sequence ids and an alignment matrix to a MultipleSeqAlignment object
+
+    """
+
+    records = []
+    for i in range(0, len(ids)):
+        records.append(SeqRecord(Seq(matrix[i].tobytes().decode()), id=ids[i], description=""))
+
+    return MultipleSeqAlignment(records)
+#
+
+
+def readMSA(filename, fmt="fasta"):
+    """Read an alignment (packed or in the given format) as a MultipleSeqAlignment object
+
+    """
+
+    if (isPackedAlignment(filename)):
+        return matrixToMSA(*readPackedAlignment(filename))
+    else:
+        return AlignIO.read(filename, fmt)
+#
+
+
+def iterAlignment(filename, fmt="fasta"):
+    """Iterate over the sequences in an alignment (packed or in the given format) as SeqRecord objects
+
+    """
+
+    if (isPackedAlignment(filename)):
+        (ids, matrix) = readPackedAlignment(filename)
+        for i in range(0, len(ids)):
+            yield SeqRecord(Seq(matrix[i].tobytes().decode()), id=ids[i], description="")
+    else:
+        for seq in SeqIO.parse(filename, fmt):
+            yield seq
+#
+
+
+def msaToMatrix(msa):
+    """Convert a MultipleSeqAlignment object to a list of sequence ids and a uint8 matrix
+
+    """
+
+    ids    = [seq.id for seq in msa]
+    matrix = np.frombuffer("".join([str(seq.seq) for seq in msa]).encode(), dtype=np.uint8)
+
+    return (ids, matrix.reshape(len(ids), -1 if len(ids) > 0 else 0))
+#
+
+
+def writeFastaRecord(handle, seqid, seq, linewidth=60):
+    """Write a single sequence (bytes) to an open binary file handle in fasta format
+
+    """
+
+    handle.write(b">"+seqid.encode()+b"\n")
+    for j in range(0, len(seq), linewidth):
+        handle.write(seq[j:j+linewidth]+b"\n")
+#
+
+
+def writeFastaMatrix(ids, matrix, filename, keep=None, linewidth=60):
+    """Write an alignment matrix to a fasta file one sequence at a time
+
+    If keep is a boolean column mask only the kept columns are written, so the trimmed
+    alignment is never held in memory as a whole.
+
+    """
+
+    with open(filename, "wb") as f:
+        for i in range(0, len(ids)):
+            seq = matrix[i] if keep is None else matrix[i, keep]
+            writeFastaRecord(f, ids[i], seq.tobytes(), linewidth)
+#
+
+
+def indexFasta(filename):
+    """Scan a fasta file and return a dictionary with the position of every sequence, without
+    parsing the sequences
+
+    Every entry is (length, offset, linebases, linewidth) as in a samtools .fai index:
+        - length    : number of characters in the sequence
+        - offset    : byte offset of the first character of the sequence
+        - linebases : number of characters on each line
+        - linewidth : number of bytes on each line (including the newline)
+
+    """
+
+    index = dict()
+    entry = None
+
+    def closeEntry(entry):
+        if (entry is not None):
+            (seqid, length, offset, linebases, linewidth, lastbases) = entry
+            index[seqid] = (length, offset, linebases, linewidth)
+
+    with open(filename, "rb") as f:
+        pos = 0
+        for line in f:
+            if (line.startswith(b">")):
+                closeEntry(entry)
+                header = line[1:].split(None, 1)
+                entry  = [header[0].decode() if len(header) > 0 else "", 0, pos+len(line), 0, 0, None]
+            elif (entry is not None):
+                bases = len(line.rstrip(b"\r\n"))
+                if (bases > 0):
+                    if (entry[5] is not None and entry[5] != entry[3]):
+                        raise ValueError("Sequence %s in %s has lines of different lengths" % (entry[0], filename))
+                    if (entry[3] == 0):
+                        (entry[3], entry[4]) = (bases, len(line))
+                    entry[1] += bases
+                    entry[5]  = bases
+            pos += len(line)
+        closeEntry(entry)
+
+    return index
+#
+
+
+def writeFastaIndex(index, filename):
+    """Write a fasta index to a tab-separated file in samtools .fai format
+
+    """
+
+    with open(filename, "w") as f:
+        for seqid in index:
+            f.write("%s\t%d\t%d\t%d\t%d\n" % ((seqid,) + tuple(index[seqid])))
+#
+
+
+def readFastaIndex(filename):
+    """Read a fasta index in samtools .fai format
+
+    """
+
+    index = dict()
+    with open(filename, "r") as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            index[parts[0]] = tuple(map(int, parts[1:5]))
+
+    return index
+#
+
+
+def loadFastaIndex(filename):
+    """Return the index of a fasta file, reading it from the sidecar filename.fai if it is newer
+    than the fasta file, otherwise building it and saving it as filename.fai for next time
+
+    """
+
+    indexfile = filename+".fai"
+    if (os.path.exists(indexfile) and os.path.getmtime(indexfile) >= os.path.getmtime(filename)):
+        return readFastaIndex(indexfile)
+
+    index = indexFasta(filename)
+    try:
+        writeFastaIndex(index, indexfile)
+    except (IOError, OSError):
+        sys.stdout.write("Warning: Could not save fasta index to %s\n" % indexfile)
+
+    return index
+#
+
+
+def fetchFastaSequence(handle, entry):
+    """Read a single sequence (as bytes) from an open binary fasta file using its index entry
+
+    """
+
+    (length, offset, linebases, linewidth) = entry
+    if (length == 0):
+        return b""
+
+    nbytes = (length // linebases)*linewidth + length % linebases
+    handle.seek(offset)
+
+    return handle.read(nbytes).replace(b"\n", b"").replace(b"\r", b"")
+#
+
+
+class SequenceLookup:
+    """Function that returns the sequence (as bytes) for an id in an alignment (fasta or packed),
+    reading it from disk only when it is requested
+
+    The fasta file stays open until close() is called (or the end of a with block).
+
+    """
+
+    def __init__(self, filename):
+        if (isPackedAlignment(filename)):
+            (self.ids, self.matrix) = readPackedAlignment(filename)
+            self.rows   = dict(zip(self.ids, range(0, len(self.ids))))
+            self.handle = None
+        else:
+            self.index  = loadFastaIndex(filename)
+            self.ids    = list(self.index.keys())
+            self.handle = open(filename, "rb")
+
+    def __call__(self, seqid):
+        if (self.handle is None):
+            return self.matrix[self.rows[seqid]].tobytes()
+        else:
+            return fetchFastaSequence(self.handle, self.index[seqid])
+
+    def close(self):
+        if (self.handle is not None):
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+#
+
+
+def getSequenceLookup(filename):
+    """Return the list of sequence ids in an alignment (fasta or packed) and a SequenceLookup that 
+    returns the sequence (as bytes) for an id, reading it from disk only when it is requested
+
+    The lookup should be closed (lookup.close() or a with block) when it is no longer needed.
+
+    """
+
+    lookup = SequenceLookup(filename)
+
+    return (lookup.ids, lookup)
+#
+
+
+def countSitePatterns(filename):
+    """Return the number of sequences, columns and unique site patterns (distinct columns) in an 
+    alignment (fasta or packed), reading one sequence at a time
+
+    Every column is hashed incrementally (64-bit polynomial hash over the sequences), so only one
+    sequence and one hash per column are in memory at a time. Lower case characters are counted 
+    as upper case.
+
+    """
+
+    upper = getUpperTable().astype(np.uint64)
+    (ids, lookup) = getSequenceLookup(filename)
+
+    hashes = None
+    with lookup:
+        for seqid in ids:
+            seq = upper[np.frombuffer(lookup(seqid), dtype=np.uint8)]
+            if (hashes is None):
+                hashes = np.zeros(len(seq), dtype=np.uint64)
+            hashes = hashes*np.uint64(1099511628211) + seq + np.uint64(1)
+
+    if (hashes is None):
+        return (0, 0, 0)
+
+    return (len(ids), len(hashes), len(np.unique(hashes)))
+#
+
+
+def compressSitePatterns(matrix):
+    """Collapse identical columns of an alignment matrix into unique site patterns
+
+    Returns a (sequences x patterns) matrix of the unique patterns (upper case, in the order they 
+    first occur), the weight (number of columns) of every pattern, the first column of every 
+    pattern and the pattern of every column.
+
+    """
+
+    (nseqs, ncols) = matrix.shape
+    columns = np.ascontiguousarray(getUpperTable()[matrix].T)
+    keys    = columns.view(np.dtype((np.void, nseqs))).ravel()
+
+    (unique, first, inverse, counts) = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+
+    # Order patterns by first occurrence
+    order = np.argsort(first)
+    rank  = np.empty_like(order)
+    rank[order] = np.arange(0, len(order))
+
+    return (columns[first[order]].T, counts[order], first[order], rank[inverse.ravel()])
+#
+
+
+def getSequenceStats(ids, matrix, chunksize=4096):
+    """Return a dictionary with per-sequence statistics of an alignment matrix
+
+    For every sequence: aligned length, ungapped length (without "-" and "N"), number of N's, 
+    number of ambiguous characters (RYWSKMDVHB) and number of gaps ("-"). Lower case characters
+    are counted as upper case.
+
+    """
+
+    upper = getUpperTable()
+    (nseqs, ncols) = matrix.shape
+    ambiguous = np.zeros(256, dtype=bool)
+    ambiguous[[ord(c) for c in "RYWSKMDVHB"]] = True
+
+    stats = dict()
+    stats["id"]        = list(ids)
+    stats["length"]    = np.full(nseqs, ncols, dtype=np.int64)
+    stats["N"]         = np.zeros(nseqs, dtype=np.int64)
+    stats["ambiguous"] = np.zeros(nseqs, dtype=np.int64)
+    stats["gaps"]      = np.zeros(nseqs, dtype=np.int64)
+
+    for start in range(0, nseqs, chunksize):
+        chunk = upper[matrix[start:start+chunksize]]
+        stats["N"][start:start+chunksize]         = np.count_nonzero(chunk == ord("N"), axis=1)
+        stats["gaps"][start:start+chunksize]      = np.count_nonzero(chunk == ord("-"), axis=1)
+        stats["ambiguous"][start:start+chunksize] = np.count_nonzero(ambiguous[chunk], axis=1)
+
+    stats["ungapped"] = stats["length"] - stats["N"] - stats["gaps"]
+
+    return stats
+#
+
+
+SEQUENCE_STATS = ["length", "ungapped", "N", "ambiguous", "gaps"]
+
+def writeSequenceStats(stats, filename):
+    """Write per-sequence statistics to a csv file
+
+    """
+
+    with open(filename, "w") as f:
+        f.write(",".join(["id"]+SEQUENCE_STATS)+"\n")
+        for i in range(0, len(stats["id"])):
+            f.write(",".join([stats["id"][i]]+[str(stats[col][i]) for col in SEQUENCE_STATS])+"\n")
+#
+
+
+def readSequenceStats(filename):
+    """Read per-sequence statistics from a csv file
+
+    """
+
+    with open(filename, "r") as f:
+        header = f.readline().strip().split(",")
+        rows   = [line.rstrip("\n").rsplit(",", len(header)-1) for line in f]
+
+    stats = dict()
+    stats["id"] = [row[0] for row in rows]
+    for j in range(1, len(header)):
+        stats[header[j]] = np.array([int(row[j]) for row in rows], dtype=np.int64)
+
+    return stats
+#
+
+
+def loadSequenceStats(filename):
+    """Return per-sequence statistics of an alignment (fasta or packed), reading them from the
+    sidecar filename.stats.csv if it is newer than the alignment, otherwise computing them and 
+    saving them as filename.stats.csv for next time
+
+    """
+
+    statsfile = filename+".stats.csv"
+    if (os.path.exists(statsfile) and os.path.getmtime(statsfile) >= os.path.getmtime(filename)):
+        return readSequenceStats(statsfile)
+
+    stats = getSequenceStats(*readAlignmentMatrix(filename))
+    try:
+        writeSequenceStats(stats, statsfile)
+    except (IOError, OSError):
+        sys.stdout.write("Warning: Could not save sequence statistics to %s\n" % statsfile)
+
+    return stats
+#
+
+
+def getUpperTable():
+    """Return a lookup table that maps every byte to its upper case equivalent
+
+    """
+
+    table = np.arange(256, dtype=np.uint8)
+    table[ord("a"):ord("z")+1] -= 32
+    return table
+#
+
+
+
+################################################################################################################################
+# Convert fasta alignments to packed alignments
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog [option] alignment1.fas [alignment2.fas ...]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-o","--outputpath",
+                      dest = "outputpath",
+                      default = "",
+                      metavar = "path",
+                      help = "Path to save packed alignments in (default: same as input) [optional]")
+
+    (options,args) = parser.parse_args()
+
+    for inputfile in args:
+        inputfile  = os.path.abspath(inputfile)
+        outputpath = os.path.abspath(options.outputpath)+"/" if options.outputpath != "" else os.path.dirname(inputfile)+"/"
+        outputfile = outputpath+inputfile[inputfile.rfind("/")+1:inputfile.rfind(".")]+".msapack"
+
+        if (not os.path.exists(outputpath)):
+            os.mkdir(outputpath)
+
+        (ids, matrix) = readFastaMatrix(inputfile)
+        writePackedAlignment(ids, matrix, outputfile)
+        sys.stdout.write("%s: %d sequences x %d columns -> %s\n" % (inputfile, matrix.shape[0], matrix.shape[1], outputfile))
@@ -1,4 +1,6 @@
-import sys, datetime
+import sys, time, datetime
+import numpy as np
+from functools import lru_cache
 
 ########################################################
 # Some functions for working with and converting dates #
@@ -14,18 +16,223 @@ def str2int(s):
 #
 
 
+@lru_cache(maxsize=None)
+def getYearDays(year):
+    """Return the number of days in a year (cached)
+
+    """
+
+    return (datetime.date(year, 12, 31).timetuple().tm_yday)
+#
+
+
 def getDoubleDate(date): 
     """Given datetime object return the decimal date for it
 
     """
 
-    dec31   = datetime.datetime.strptime(str(date.year)+"-12-31", "%Y-%m-%d")
+    return (date.year + float(date.timetuple().tm_yday-1)/getYearDays(date.year))
+##
 
-    datett  = date.timetuple()
-    dec31tt = dec31.timetuple()
 
-    return (date.year + float(datett.tm_yday-1)/dec31tt.tm_yday)
-##
+def isLeapYear(years):
+    """Return True for leap years (works on numpy arrays of years)
+
+    """
+
+    return ((years % 4 == 0) & (years % 100 != 0)) | (years % 400 == 0)
+#
+
+
+MONTHDAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+CUMDAYS   = np.concatenate(([0], np.cumsum(MONTHDAYS)))
+
+
+def getMonthDays(years, months):
+    """Return the number of days in the given months (works on numpy arrays, months 1-12)
+
+    """
+
+    return MONTHDAYS[months-1] + isLeapYear(years)*(months == 2)
+#
+
+
+def getDoubleDateArray(years, months, days):
+    """Return decimal dates for numpy arrays of (valid) years, months and days
+
+    """
+
+    leap = isLeapYear(years).astype(np.int64)
+    yday = CUMDAYS[months-1] + leap*(months > 2) + days
+
+    return years + (yday - 1)/(365.0 + leap)
+#
+
+
+def splitDateStrings(datestrings):
+    """Split an array of zero-padded date strings (yyyy-mm-dd, yyyy-mm or yyyy) into numpy arrays 
+    of years, months and days in one vectorized pass
+
+    Missing months and days are 0. Strings that are not valid dates in one of these formats 
+    have a year of -1.
+
+    """
+
+    dates  = np.asarray(datestrings, dtype=str)
+    n      = len(dates)
+    years  = np.full(n, -1, dtype=np.int64)
+    months = np.zeros(n, dtype=np.int64)
+    days   = np.zeros(n, dtype=np.int64)
+    if (n == 0):
+        return (years, months, days)
+
+    lengths = np.char.str_len(dates)
+    for (length, dashes, digits) in [(10, [4,7], [0,1,2,3,5,6,8,9]), (7, [4], [0,1,2,3,5,6]), (4, [], [0,1,2,3])]:
+        idx = np.flatnonzero(lengths == length)
+        if (len(idx) == 0):
+            continue
+
+        chars = dates[idx].astype("U%d" % length).view(np.uint32).reshape(-1, length).astype(np.int64) - ord("0")
+        valid = np.all((chars[:,digits] >= 0) & (chars[:,digits] <= 9), axis=1) & np.all(chars[:,dashes] == ord("-")-ord("0"), axis=1)
+
+        y = chars[:,0]*1000 + chars[:,1]*100 + chars[:,2]*10 + chars[:,3]
+        m = chars[:,5]*10 + chars[:,6] if length > 4 else np.zeros(len(idx), dtype=np.int64)
+        d = chars[:,8]*10 + chars[:,9] if length > 7 else np.zeros(len(idx), dtype=np.int64)
+
+        if (length > 4):
+            valid &= (m >= 1) & (m <= 12)
+        if (length > 7):
+            valid &= (d >= 1) & (d <= getMonthDays(y, np.clip(m, 1, 12)))
+
+        years[idx[valid]]  = y[valid]
+        months[idx[valid]] = m[valid]
+        days[idx[valid]]   = d[valid]
+
+    return (years, months, days)
+#
+
+
+def getDateBounds(datestring, datefmt="%Y-%m-%d"):
+    """Return the decimal date and lower and upper bounds for a date string with unknown 
+    day (yyyy-mm) or unknown month and day (yyyy) 
+
+        - yyyy-mm-dd : the date (bounds are equal to the date)
+        - yyyy-mm    : the 15th of the month (bounds are the first and last day of the month)
+        - yyyy       : the 1st of July (bounds are the first and last day of the year)
+
+    """
+
+    parts = datestring.split("-")
+    if (len(parts) == 3):
+        date  = datetime.datetime.strptime(datestring, datefmt)
+        lower = upper = date
+    elif (len(parts) == 2):
+        date  = datetime.datetime.strptime(datestring+"-15", datefmt)
+        lower = datetime.datetime(date.year, date.month, 1)
+        upper = datetime.datetime(date.year, date.month, getMonthDays(date.year, date.month))
+    elif (len(parts) == 1):
+        date  = datetime.datetime.strptime(datestring+"-07-01", datefmt)
+        lower = datetime.datetime(date.year, 1, 1)
+        upper = datetime.datetime(date.year, 12, 31)
+
+    return (getDoubleDate(date), getDoubleDate(lower), getDoubleDate(upper))
+#
+
+
+def getDecimalDates(datestrings, datefmt="%Y-%m-%d"):
+    """Given a list or array of date strings (yyyy-mm-dd, yyyy-mm or yyyy) return numpy arrays of
+    decimal dates, lower bounds and upper bounds, as in getDateBounds()
+
+    Zero-padded dates are converted in one vectorized pass, anything else falls back to 
+    getDateBounds(). Dates that cannot be parsed are returned as NaN.
+
+    """
+
+    (years, months, days) = splitDateStrings(datestrings)
+    n      = len(years)
+    dates  = np.full(n, np.nan)
+    lower  = np.full(n, np.nan)
+    upper  = np.full(n, np.nan)
+
+    # Full dates
+    idx = np.flatnonzero((years >= 0) & (days > 0))
+    dates[idx] = lower[idx] = upper[idx] = getDoubleDateArray(years[idx], months[idx], days[idx])
+
+    # Year and month
+    idx = np.flatnonzero((years >= 0) & (months > 0) & (days == 0))
+    (y, m) = (years[idx], months[idx])
+    dates[idx] = getDoubleDateArray(y, m, np.full(len(idx), 15))
+    lower[idx] = getDoubleDateArray(y, m, np.ones(len(idx), dtype=np.int64))
+    upper[idx] = getDoubleDateArray(y, m, getMonthDays(y, m))
+
+    # Only year
+    idx = np.flatnonzero((years >= 0) & (months == 0))
+    y = years[idx]
+    dates[idx] = getDoubleDateArray(y, np.full(len(idx), 7), np.ones(len(idx), dtype=np.int64))
+    lower[idx] = getDoubleDateArray(y, np.ones(len(idx), dtype=np.int64), np.ones(len(idx), dtype=np.int64))
+    upper[idx] = getDoubleDateArray(y, np.full(len(idx), 12), np.full(len(idx), 31))
+
+    # Anything else (e.g. dates without zero-padding)
+    datestrings = np.asarray(datestrings, dtype=str)
+    for i in np.flatnonzero(years < 0):
+        try:
+            (dates[i], lower[i], upper[i]) = getDateBounds(datestrings[i], datefmt)
+        except (ValueError, UnboundLocalError):
+            pass
+
+    return (dates, lower, upper)
+#
+
+
+def getDoubleDates(datestrings, datefmt="%Y-%m-%d"):
+    """Given a list or array of date strings (yyyy-mm-dd) return a numpy array of decimal dates
+
+    Only full dates are converted, anything else is returned as NaN. Zero-padded dates are 
+    converted in one vectorized pass, anything else falls back to strptime.
+
+    """
+
+    (years, months, days) = splitDateStrings(datestrings)
+    result = np.full(len(years), np.nan)
+
+    idx = np.flatnonzero((years >= 0) & (days > 0))
+    result[idx] = getDoubleDateArray(years[idx], months[idx], days[idx])
+
+    datestrings = np.asarray(datestrings, dtype=str)
+    for i in np.flatnonzero(years < 0):
+        try:
+            result[i] = getDoubleDate(datetime.datetime.strptime(datestrings[i], datefmt))
+        except ValueError:
+            pass
+
+    return result
+#
+
+
+def getDayDoubleDates(days):
+    """Given a numpy array of days (datetime64[D]) return a numpy array of decimal dates
+
+    """
+
+    days  = np.asarray(days, dtype="datetime64[D]")
+    years = days.astype("datetime64[Y]").astype(np.int64) + 1970
+    yday  = (days - days.astype("datetime64[Y]")).astype(np.int64)
+
+    return years + yday/(365.0 + isLeapYear(years))
+#
+
+
+def getDecimalDays(decimaldates):
+    """Given a numpy array of decimal dates return the (nearest) days as datetime64[D]
+
+    """
+
+    decimaldates = np.asarray(decimaldates, dtype=float)
+    years = np.floor(decimaldates).astype(np.int64)
+    yday  = np.rint((decimaldates - years)*(365 + isLeapYear(years))).astype(np.int64)
+
+    return (years - 1970).astype("datetime64[Y]").astype("datetime64[D]") + yday
+#
 
 
 def getDateString(year, month=None, day=None, calendar=True, digits=None):
@@ -103,25 +310,76 @@ def getDateString(year, month=None, day=None, calendar=True, digits=None):
 ################################################################################################################################  
 # Some tests
 
-if __name__ == "__main__":
+def getYearDateStrptime(datestring, datefmt="%Y-%m-%d"):
+    """Return the decimal date and the earlier and later bound of a date string, one date at a time
+    with strptime (the per-call conversion in makeBeastXML.getYearDate, with the original
+    getDoubleDate that parses Dec 31 of the year for every date). Only used as the reference in
+    benchmarkDates()
 
-  years  = ["2015", "2015", "2000", "2015", "2016", "2016"]
-  months = ["01",   "12",   "05",   "02",   "02",   "NA"]
-  days   = ["01",   "31",   "15",   "NA",   "NA",   "NA"]
+    """
 
-  for i in range(0,len(years)):
+    def getDoubleDateStrptime(date):
+        dec31 = datetime.datetime.strptime(str(date.year)+"-12-31", "%Y-%m-%d")
+        return (date.year + float(date.timetuple().tm_yday-1)/dec31.timetuple().tm_yday)
+
+    if (datestring.count("-") == 2):
+        date  = datetime.datetime.strptime(datestring, datefmt)
+        (lower, upper) = (date, date)
+    elif (datestring.count("-") == 1):
+        date  = datetime.datetime.strptime(datestring+"-15", datefmt)
+        lower = datetime.datetime.strptime("%d-%d-01" % (date.year, date.month), datefmt)
+        if (date.month == 12):
+            day = 31
+        else:
+            day = (datetime.date(date.year, date.month+1, 1)-datetime.date(date.year, date.month, 1)).days
+        upper = datetime.datetime.strptime("%d-%d-%d" % (date.year, date.month, day), datefmt)
+    else:
+        date  = datetime.datetime.strptime(datestring+"-07-01", datefmt)
+        lower = datetime.datetime.strptime(datestring+"-01-01", datefmt)
+        upper = datetime.datetime.strptime(datestring+"-12-31", datefmt)
 
-      sys.stdout.write("%s-%s-%s = " % (years[i], months[i], days[i]))
-      sys.stdout.write("%-10s =" % getDateString(years[i],months[i],days[i],calendar=True))
-      sys.stdout.write("%19s =" % getDateString(years[i],months[i],days[i],calendar=False))
-      sys.stdout.write("%9s\n" % getDateString(years[i],months[i],days[i],calendar=False, digits=3))
+    return (getDoubleDateStrptime(date), getDoubleDateStrptime(lower), getDoubleDateStrptime(upper))
+#
 
 
+def benchmarkDates(n=1000000, seed=127):
+    """Time converting n random date strings (full, year-month and year-only) one at a time with
+    strptime (as makeBeastXML.getYearDate did) and all at once
 
+    """
 
+    rng   = np.random.RandomState(seed)
+    start = datetime.date(2013, 1, 1)
+    dates = [(start + datetime.timedelta(days=int(d))).isoformat() for d in rng.randint(0, 3*365, size=n)]
+    kinds = rng.randint(0, 10, size=n)
+    dates = [d if k < 8 else (d[:7] if k == 8 else d[:4]) for (d, k) in zip(dates, kinds)]
+
+    t0 = time.time()
+    single = [getYearDateStrptime(d) for d in dates]
+    t1 = time.time()
+    (ddates, lower, upper) = getDecimalDates(dates)
+    t2 = time.time()
+
+    equal = np.array_equal(np.array(single), np.column_stack((ddates, lower, upper)))
+    sys.stdout.write("%d dates\n" % n)
+    sys.stdout.write("Per-call (strptime) : %10.4f seconds\n" % (t1-t0))
+    sys.stdout.write("Vectorized          : %10.4f seconds (%.1fx faster)\n" % (t2-t1, (t1-t0)/max(t2-t1, 1e-9)))
+    sys.stdout.write("Results identical: %s\n" % equal)
+#
 
 
+if __name__ == "__main__":
 
+  years  = ["2015", "2015", "2000", "2015", "2016", "2016"]
+  months = ["01",   "12",   "05",   "02",   "02",   "NA"]
+  days   = ["01",   "31",   "15",   "NA",   "NA",   "NA"]
 
+  for i in range(0,len(years)):
 
+      sys.stdout.write("%s-%s-%s = " % (years[i], months[i], days[i]))
+      sys.stdout.write("%-10s =" % getDateString(years[i],months[i],days[i],calendar=True))
+      sys.stdout.write("%19s =" % getDateString(years[i],months[i],days[i],calendar=False))
+      sys.stdout.write("%9s\n" % getDateString(years[i],months[i],days[i],calendar=False, digits=3))
 
+  if (len(sys.argv) > 1 and sys.argv[1] == "benchmark"):
+      benchmarkDates(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
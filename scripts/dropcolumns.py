@@ -1,11 +1,13 @@
 
 import os, sys, time
+import numpy as np
 from optparse import OptionParser
 from Bio import AlignIO
 from Bio.Alphabet import generic_dna
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Align import MultipleSeqAlignment
+from alignutils import readMSA, msaToMatrix, matrixToMSA
 
 # Given alignment and list of columns removes those columns from the alignment
 ###################################################################################################
@@ -13,14 +15,132 @@ from Bio.Align import MultipleSeqAlignment
 # As standalone program:
 # - List of columns can be provided as a comma-separated file
 # - Alignment should be in fasta format
+# - Use -I to keep only the listed columns instead
 #
 ###################################################################################################
 
 
+def getColumnMask(ncols, cols):
+	"""Return a boolean mask over ncols columns that is True for the columns in cols
+
+	   Columns outside the alignment are ignored
+	"""
+
+	cols = np.asarray(list(cols), dtype=np.int64)
+	mask = np.zeros(ncols, dtype=bool)
+	mask[cols[(cols >= 0) & (cols < ncols)]] = True
+
+	return(mask)
+#
+
+
+def resizeColumnMask(mask, ncols):
+	"""Truncate a column mask or pad it with False to ncols columns
+
+	"""
+
+	if (len(mask) >= ncols):
+		return(mask[:ncols])
+	else:
+		return(np.concatenate((mask, np.zeros(ncols-len(mask), dtype=bool))))
+#
+
+
+def combineColumnMasks(masks, combine="union"):
+	"""Combine column masks by union (columns selected by any mask) or intersection (columns
+	   selected by all masks)
+
+	   Masks of different lengths are padded with False to the longest mask
+	"""
+
+	if (len(masks) == 0):
+		return(np.zeros(0, dtype=bool))
+
+	ncols = max([len(mask) for mask in masks])
+	masks = [resizeColumnMask(mask, ncols) for mask in masks]
+
+	if (combine == "union"):
+		return(np.logical_or.reduce(masks))
+	elif (combine == "intersection"):
+		return(np.logical_and.reduce(masks))
+	else:
+		raise ValueError("Unknown way to combine column masks: %s" % combine)
+#
+
+
+def getMaskColumns(mask):
+	"""Return the list of columns that are True in a column mask
+
+	"""
+
+	return(np.flatnonzero(mask).tolist())
+#
+
+
+def getKeepMask(ncols, dropcols):
+	"""Return a boolean mask over ncols columns that is False for the columns to drop
+
+	   dropcols is either a list of columns or a boolean mask of columns to drop
+	   Columns outside the alignment are ignored
+	"""
+
+	if (isinstance(dropcols, np.ndarray) and dropcols.dtype == bool):
+		return(~resizeColumnMask(dropcols, ncols))
+	else:
+		return(~getColumnMask(ncols, dropcols))
+#
+
+
+def getKeptRanges(keep):
+	"""Return the [start,end) ranges of consecutive kept columns in a keep mask
+
+	"""
+
+	edges  = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+	starts = np.flatnonzero(edges == 1)
+	ends   = np.flatnonzero(edges == -1)
+
+	return(list(zip(starts.tolist(), ends.tolist())))
+#
+
+
+def dropcolumnsMatrix(matrix, dropcols, verbose=False):
+	"""Remove list of columns (or boolean mask of columns) from an alignment matrix and return a new matrix
+
+	   Start numbering columns from 0
+	"""
+
+	keep = getKeepMask(matrix.shape[1], dropcols)
+
+	if (verbose):
+		for (start, end) in getKeptRanges(keep):
+			sys.stdout.write("[%d,%d)\n" % (start,end))
+
+	return(matrix[:,keep])
+#
+
+
 def dropcolumns(msa, dropcols, verbose=False):
+	"""Remove list of columns (or boolean mask of columns) from an msa and return a new msa object
+
+	   Start numbering columns from 0
+
+	   All kept columns are extracted for all sequences at once through a boolean mask
+	"""
+
+	(ids, matrix) = msaToMatrix(msa)
+
+	return(matrixToMSA(ids, dropcolumnsMatrix(matrix, dropcols, verbose=verbose)))
+#
+
+
+def dropcolumnsConcat(msa, dropcols, verbose=False):
 	"""Remove list of columns from an msa and return a new msa object
 
 	   Start numbering columns from 0
+
+	   Old implementation that concatenates the kept blocks one at a time (slow when many
+	   scattered columns are dropped), used for benchmarking
 	"""
 
 	# Create blank alignment
@@ -67,6 +187,30 @@ def testdropcolumns(teststr, dropcols):
 #
 
 
+def benchmarkdropcolumns(msa, proportions=[0.01, 0.1, 0.5], seed=127):
+	"""Time dropping randomly scattered columns with the old and new implementations
+
+	"""
+
+	rng   = np.random.RandomState(seed)
+	ncols = msa.get_alignment_length()
+	sys.stdout.write("Alignment: %d sequences x %d columns\n" % (len(msa), ncols))
+	sys.stdout.write("%10s%10s%15s%15s%10s%10s\n" % ("dropped", "columns", "concat (s)", "mask (s)", "speedup", "equal"))
+
+	for p in proportions:
+		dropcols = rng.choice(ncols, int(round(p*ncols)), replace=False).tolist()
+
+		t0 = time.time()
+		old = dropcolumnsConcat(msa, dropcols)
+		t1 = time.time()
+		new = dropcolumns(msa, dropcols)
+		t2 = time.time()
+
+		equal = all([a.id == b.id and str(a.seq) == str(b.seq) for (a,b) in zip(old, new)])
+		sys.stdout.write("%9.0f%%%10d%15.4f%15.4f%9.1fx%10s\n" % (p*100, len(dropcols), t1-t0, t2-t1, (t1-t0)/max(t2-t1, 1e-9), equal))
+#
+
+
 
 ###################################################################################################
 
@@ -90,7 +234,7 @@ if __name__ == "__main__":
 	                  dest = "alignfile",
 	                  default = "",
 	                  metavar = "path",
-	                  help = "Path to input alignment file to extract sequences from [optional]")
+	                  help = "Path to input alignment file (fasta or packed) to extract sequences from [optional]")
 
 	parser.add_option("-o","--outputpath",
 	                  dest = "outputpath",
@@ -104,11 +248,21 @@ if __name__ == "__main__":
 	                  metavar = "string",
 	                  help = "Prefix for the output file(s) [default: %default] [required]")
 
+	parser.add_option("-I","--inverse",
+	                  dest = "inverse",
+	                  action = "store_true",
+	                  help = "Do the inverse (remove all but the listed columns) [default: %default] [optional]")
+
 	parser.add_option("-t","--test",
 	                  dest = "test",
 	                  action = "store_true",
 	                  help = "Run a test [default: %default] [optional]")
 
+	parser.add_option("-b","--benchmark",
+	                  dest = "benchmark",
+	                  action = "store_true",
+	                  help = "Benchmark dropping 1%, 10% and 50% of randomly scattered columns from the alignment (or a random alignment if none is given) [default: %default] [optional]")
+
 
 	(options,args) = parser.parse_args()
 
@@ -117,6 +271,7 @@ if __name__ == "__main__":
 	outputpath = os.path.abspath(options.outputpath)+"/"
 	prefix     = options.prefix
 	test       = options.test
+	benchmark  = options.benchmark
 
 	###################################################################################################	
 
@@ -129,10 +284,17 @@ if __name__ == "__main__":
 		testdropcolumns("CCCG"+("A"*5)+"GC", [0,1,2,10])
 		testdropcolumns("CCCG"+("A"*5)+"GCCC", [0,1,2,10,11,12])
 		testdropcolumns(("A"*5)+"GCCCG"+("A"*5), [6,7,8])
+	elif (benchmark):
+		if (alignfile != ""):
+			msa = readMSA(alignfile)
+		else:
+			rng = np.random.RandomState(127)
+			msa = matrixToMSA(["seq%d" % i for i in range(0,200)], np.frombuffer(b"ACGT", dtype=np.uint8)[rng.randint(0, 4, size=(200, 18000))])
+		benchmarkdropcolumns(msa)
 	else:
 
 		# Read input
-		msa = AlignIO.read(alignfile, "fasta")
+		msa = readMSA(alignfile)
 
 		with open(inputfile, 'r') as f:
 			templist = []
@@ -144,6 +306,8 @@ if __name__ == "__main__":
 		print(len(dropcols))
 		
 		# Drop columns
+		if (options.inverse):
+			dropcols = ~getColumnMask(msa.get_alignment_length(), dropcols)
 		msa = dropcolumns(msa, dropcols, verbose=False)
 
 		# Save output
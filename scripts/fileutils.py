@@ -1,3 +1,4 @@
+import csv, gc
 import yaml
 
 
@@ -36,3 +37,59 @@ def getMapping(header, fieldmapping):
     return mapping
 #
 
+
+def readQuotedRows(text, sep=","):
+    """Parse csv text with quoted fields in one pass and return the rows and the raw text of 
+    every row (quoted fields may span several lines, so a row can be more than one line)
+
+    """
+
+    consumed = []
+    def readLines():
+        for line in text.splitlines(True):
+            consumed.append(line)
+            yield line
+
+    rows  = []
+    lines = []
+    for row in csv.reader(readLines(), delimiter=sep):
+        rows.append(row)
+        lines.append("".join(consumed).rstrip("\r\n"))
+        del consumed[:]
+
+    return (rows, lines)
+#
+
+
+def readMetadataColumns(inputfile, sep=","):
+    """Read metadata csv file into columns
+
+    Returns the header, the (stripped) text of every row (a quoted field may span several lines)
+    and a list of tuples with the values in each column. Rows with fewer fields than the header
+    are padded with "NA".
+
+    """
+
+    with open(inputfile, "r", newline="") as db:
+        text = db.read()
+
+    # The garbage collector is paused while millions of (acyclic) field strings are created
+    gc.disable()
+    try:
+        # Only use the (slower) csv parser if there are quoted fields
+        if ('"' in text):
+            (rows, lines) = readQuotedRows(text, sep)
+        else:
+            lines = text.splitlines()
+            rows  = [line.strip().split(sep) for line in lines]
+        header = rows[0]
+        ncols  = len(header)
+        rows   = [row if len(row) == ncols else (row+["NA"]*ncols)[:ncols] for row in rows[1:]]
+
+        columns = list(zip(*rows)) if len(rows) > 0 else [()]*ncols
+        lines   = [line.strip() for line in lines[1:]]
+    finally:
+        gc.enable()
+
+    return (header, lines, columns)
+#
@@ -0,0 +1,333 @@
+import os, sys, io, time, glob
+import numpy as np
+from fnmatch import fnmatch
+from optparse import OptionParser
+from fileutils import parseList
+
+
+# Read BEAST trace logs
+################################################################################################################################
+#
+# - Logs are read in chunks of bytes and only the selected columns of every chunk are parsed into a
+#   numpy array at once, so memory is bounded by the chunk size and the selected columns
+# - Burn-in is skipped by sample number: the first row after the burn-in is found by bisection on
+#   the byte offsets in the file, so the skipped rows are never read or parsed
+# - Columns are selected by name or glob (e.g. reproductiveNumber*)
+# - Logs of several seeds (replicates) can be combined as with LogCombiner (burn-in removed from
+#   every log, resampled and renumbered) and written to a new log file
+#
+################################################################################################################################
+
+SAMPLECOLUMN = "Sample"
+
+
+def readLogHeader(filename):
+    """Return the column names of a log file and the byte offset of the first row
+
+    Comment lines (starting with #) before the header are skipped.
+
+    """
+
+    with open(filename, "rb") as infile:
+        while (True):
+            line = infile.readline()
+            if (len(line) == 0):
+                sys.stdout.write("ERROR! No header found in %s\n" % filename)
+                raise RuntimeError
+            if (not line.startswith(b"#") and line.strip() != b""):
+                return (line.decode().strip().split("\t"), infile.tell())
+#
+
+
+def getColumns(names, patterns=[]):
+    """Return the indices of the columns matching any of the names or glob patterns (in the order
+    of the patterns, every column only once). The sample column is always included first
+
+    """
+
+    if (len(patterns) == 0):
+        return list(range(0, len(names)))
+
+    indices = [names.index(SAMPLECOLUMN)] if SAMPLECOLUMN in names else []
+    for pattern in patterns:
+        matched = [i for i in range(0, len(names)) if fnmatch(names[i], pattern) and i not in indices]
+        if (len(matched) == 0 and pattern != SAMPLECOLUMN):
+            sys.stdout.write("Warning: No columns matching %s\n" % pattern)
+        indices += matched
+
+    return indices
+#
+
+
+def getSample(line):
+    """Return the sample number (first field) of a row
+
+    """
+
+    return int(line.split(b"\t", 1)[0])
+#
+
+
+def getLastSample(filename, blocksize=2**16):
+    """Return the sample number of the last complete row in a log file (read from the end)
+
+    """
+
+    (names, offset) = readLogHeader(filename)
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as infile:
+        infile.seek(max(offset, size-blocksize))
+        lines = [line for line in infile.read().split(b"\n") if line.strip() != b""]
+
+    for line in reversed(lines[:-1] if len(lines) > 1 else lines):
+        try:
+            return getSample(line)
+        except ValueError:
+            continue
+
+    return None
+#
+
+
+def seekSample(infile, sample, lower, blocksize=2**16):
+    """Seek to the first row in an open log file (binary) with a sample number >= sample, where
+    lower is the offset of the first row, and return its offset
+
+    The offset is found by bisection on the byte offsets, followed by a short scan of at most
+    blocksize bytes, so only the sample numbers of a few rows are read.
+
+    """
+
+    infile.seek(0, os.SEEK_END)
+    upper = infile.tell()
+
+    while (upper - lower > blocksize):
+        middle = (lower + upper)//2
+        infile.seek(middle)
+        infile.readline()
+        start = infile.tell()
+        line  = infile.readline()
+        if (len(line) == 0 or not line.endswith(b"\n") or getSample(line) >= sample):
+            upper = middle
+        else:
+            lower = start
+
+    infile.seek(lower)
+    while (True):
+        start = infile.tell()
+        line  = infile.readline()
+        if (len(line) == 0 or not line.endswith(b"\n") or getSample(line) >= sample):
+            infile.seek(start)
+            return start
+#
+
+
+def parseRows(text, ncols, indices):
+    """Parse complete tab-separated rows (bytes) with ncols columns into a (rows x indices) array
+    with only the columns in indices
+
+    Non-numeric values are NaN and rows with a different number of columns are dropped (slow path).
+
+    """
+
+    try:
+        return np.loadtxt(io.BytesIO(text), dtype=float, delimiter="\t", usecols=indices, ndmin=2)
+    except ValueError:
+        pass
+
+    rows = []
+    for line in text.split(b"\n"):
+        fields = line.split(b"\t")
+        if (len(fields) == ncols):
+            rows.append([parseValue(fields[i]) for i in indices])
+
+    return np.array(rows, dtype=float).reshape(len(rows), len(indices))
+#
+
+
+def parseValue(field):
+    """Return a field as a float, or NaN if it is not a number
+
+    """
+
+    try:
+        return float(field)
+    except ValueError:
+        return np.nan
+#
+
+
+def readLog(filename, columns=[], burnin=0.0, start=None, resample=None, chunksize=2**24):
+    """Read a log file and return the names of the selected columns and a (samples x columns) array
+
+    columns  : Names or glob patterns of the columns to read (all columns if empty)
+    burnin   : Fraction of the chain (by sample number of the last row) to discard
+    start    : First sample number to read (overrides burnin)
+    resample : Only keep samples that are a multiple of this (as LogCombiner -resample)
+    chunksize: Number of bytes to read and parse at a time
+
+    """
+
+    (names, offset) = readLogHeader(filename)
+    indices = getColumns(names, columns)
+    ncols   = len(names)
+    if (resample is not None and resample > 0 and (len(indices) == 0 or names[indices[0]] != SAMPLECOLUMN)):
+        sys.stdout.write("ERROR! No %s column in %s, cannot resample\n" % (SAMPLECOLUMN, filename))
+        raise RuntimeError
+
+    if (start is None and burnin > 0):
+        last = getLastSample(filename)
+        if (last is None):
+            return ([names[i] for i in indices], np.zeros((0, len(indices))))
+        start = int(burnin*last)
+
+    chunks = []
+    with open(filename, "rb") as infile:
+        if (start is not None and start > 0):
+            seekSample(infile, start, offset)
+        else:
+            infile.seek(offset)
+
+        leftover = b""
+        while (True):
+            data = infile.read(chunksize)
+            if (len(data) == 0):
+                # Last row without a newline (dropped if incomplete, e.g. of a running chain)
+                if (len(leftover.strip()) > 0 and leftover.count(b"\t") == ncols-1):
+                    data = b"\n"
+                else:
+                    break
+
+            data = leftover + data
+            end  = data.rfind(b"\n") + 1
+            (text, leftover) = (data[:end], data[end:])
+            if (len(text) == 0):
+                continue
+
+            rows = parseRows(text, ncols, indices)
+            if (resample is not None and resample > 0 and len(rows) > 0):
+                rows = rows[rows[:,0] % resample == 0]
+            chunks.append(rows)
+
+    data = np.concatenate(chunks) if len(chunks) > 0 else np.zeros((0, len(indices)))
+
+    return ([names[i] for i in indices], data)
+#
+
+
+def combineLogs(filenames, columns=[], burnin=0.0, resample=None, chunksize=2**24):
+    """Read several log files (e.g. of replicates with different seeds) with the burn-in removed
+    from every log and combine them into one array, with the samples renumbered consecutively as by
+    LogCombiner. Return the column names, the array and the replicate (index of the file) of every row
+
+    """
+
+    names    = None
+    logs     = []
+    for filename in filenames:
+        (lognames, data) = readLog(filename, columns, burnin=burnin, resample=resample, chunksize=chunksize)
+        if (names is not None and lognames != names):
+            sys.stdout.write("ERROR! Columns of %s do not match columns of %s\n" % (filename, filenames[0]))
+            raise RuntimeError
+        names = lognames
+        logs.append(data)
+        sys.stdout.write("%s: %d samples\n" % (filename, len(data)))
+
+    if (names is None):
+        return ([], np.zeros((0, 0)), np.zeros(0, dtype=int))
+
+    data       = np.concatenate(logs)
+    replicates = np.repeat(np.arange(0, len(logs)), [len(log) for log in logs])
+
+    # Renumber samples
+    if (SAMPLECOLUMN in names and len(data) > 1):
+        step = resample if resample is not None and resample > 0 else np.median(np.diff(logs[0][:,0])) if len(logs[0]) > 1 else 1
+        data[:,names.index(SAMPLECOLUMN)] = np.arange(0, len(data))*step
+
+    return (names, data, replicates)
+#
+
+
+def writeLog(filename, names, data, fmt="%.10g"):
+    """Write a (samples x columns) array to a tab-separated log file (the sample column is written
+    as integers)
+
+    """
+
+    fmts = ["%d" if name == SAMPLECOLUMN else fmt for name in names]
+    with open(filename, "w") as outfile:
+        outfile.write("\t".join(names)+"\n")
+        np.savetxt(outfile, data, fmt=fmts, delimiter="\t")
+#
+
+
+################################################################################################################################
+
+if __name__ == "__main__":
+
+    ################################################################################################################################
+    # Parameters
+
+    usage = "usage: %prog [option]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-i","--inputfiles",
+                      dest = "inputfiles",
+                      default = "",
+                      metavar = "path",
+                      help = "Comma-separated list of log files or glob pattern (e.g. LBR*_*.log for all seeds) [required]")
+
+    parser.add_option("-o","--outputfile",
+                      dest = "outputfile",
+                      default = "",
+                      metavar = "path",
+                      help = "Combined log file to write [optional]")
+
+    parser.add_option("-c","--columns",
+                      dest = "columns",
+                      default = "",
+                      metavar = "comma-separated list of strings",
+                      help = "Names or glob patterns of the columns to read (e.g. posterior,reproductiveNumber*) [default: all columns]")
+
+    parser.add_option("-b","--burnin",
+                      dest = "burnin",
+                      default = "25",
+                      metavar = "float",
+                      help = "Burn-in percentage to discard from every log [default: %default]")
+
+    parser.add_option("-r","--resample",
+                      dest = "resample",
+                      default = "",
+                      metavar = "integer",
+                      help = "Resample the logs at this frequency (as LogCombiner) [optional]")
+
+    parser.add_option("-C","--chunksize",
+                      dest = "chunksize",
+                      default = "16",
+                      metavar = "integer",
+                      help = "MB of the log files to read and parse at a time [default: %default]")
+
+    (options,args) = parser.parse_args()
+
+    filenames = sorted(glob.glob(options.inputfiles)) if ("*" in options.inputfiles or "?" in options.inputfiles) else parseList(options.inputfiles)
+    columns   = parseList(options.columns)
+    burnin    = float(options.burnin)/100.0
+    resample  = int(options.resample) if options.resample != "" else None
+    chunksize = int(float(options.chunksize)*2**20)
+
+
+    ################################################################################################################################
+    start = time.time()
+
+    (names, data, replicates) = combineLogs(filenames, columns, burnin=burnin, resample=resample, chunksize=chunksize)
+    sys.stdout.write("%d samples of %d columns from %d logs\n" % (data.shape[0], len(names), len(filenames)))
+
+    for i in range(0, len(names)):
+        if (names[i] != SAMPLECOLUMN and len(data) > 0):
+            sys.stdout.write("%30s : mean %12.6g, 95%% interval [%.6g, %.6g]\n" % (names[i], np.nanmean(data[:,i]), np.nanpercentile(data[:,i], 2.5), np.nanpercentile(data[:,i], 97.5)))
+
+    if (options.outputfile != ""):
+        writeLog(options.outputfile, names, data)
+
+    end = time.time()
+    sys.stdout.write("Total time taken: "+str(end-start)+" seconds\n")
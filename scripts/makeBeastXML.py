@@ -1,9 +1,13 @@
-import os, sys, io, yaml, json, datetime
+import os, sys, io, re, gzip, math, yaml, json, datetime, hashlib
+import multiprocessing
 import numpy as np
 from fnmatch import fnmatch
+from string import Formatter
+from functools import partial
 from optparse import OptionParser
-from Bio import SeqIO
-from dateutils import getDoubleDate
+from dateutils import getDoubleDate, getDecimalDates, getDecimalDays
+from alignutils import getSequenceLookup, countSitePatterns, readAlignmentMatrix, compressSitePatterns
+from samplingutils import getCases, getGridProportions, isGrid
 
 usage = "usage: %prog [option]"
 parser = OptionParser(usage=usage)
@@ -56,8 +60,60 @@ parser.add_option("-q","--queue",
                   metavar = "integer",
                   help = "Queue to submit to [required]")
 
+parser.add_option("-j","--jobs",
+                  dest = "jobs",
+                  default = "1",
+                  metavar = "integer",
+                  help = "Number of processes to generate XML files with [default = %default]")
+
+parser.add_option("-C","--cachepath",
+                  dest = "cachepath",
+                  default = "~/.cache/makeBeastXML",
+                  metavar = "path",
+                  help = "Path to cache rendered alignments in (keyed by the hash of the alignment file) [default = %default]")
+
+parser.add_option("--nocache",
+                  dest = "nocache",
+                  action = "store_true",
+                  help = "Do not use the alignment cache [default = %default]")
+
+parser.add_option("-u","--incremental",
+                  dest = "incremental",
+                  action = "store_true",
+                  help = "Only make XML files whose inputs (config, template, alignments, seeds) changed since the last run and rewrite the run scripts from the manifest instead of appending [default = %default]")
+
+parser.add_option("-S","--stream",
+                  dest = "stream",
+                  action = "store_true",
+                  help = "Write sequences straight from the alignment files to the XML files one at a time, instead of rendering the alignments in memory first (does not use the alignment cache) [default = %default]")
+
+parser.add_option("-z","--gzip",
+                  dest = "gzip",
+                  action = "store_true",
+                  help = "Write gzipped XML files (need to be decompressed before running BEAST) [default = %default]")
+
+parser.add_option("-r","--replicates",
+                  dest = "replicates",
+                  action = "store_true",
+                  help = "Write a separate XML file (with its own log and state files) for every seed and a script that runs at most (cores / threads) chains at a time on the local machine [default = %default]")
+
+parser.add_option("-E","--estimate",
+                  dest = "estimate",
+                  action = "store_true",
+                  help = "Estimate memory, threads (at most -t) and wall time (hours) for every XML file from the taxa, site patterns, partitions and chain length, use them in the run scripts and write them to <name>.resources.csv [default = %default]")
+
+parser.add_option("-P","--patterns",
+                  dest = "patterns",
+                  default = "",
+                  metavar = "report/weighted",
+                  help = "Collapse identical columns in every partition into site patterns, report the compression and write <xml name>.patterns.csv (report) and also write only the patterns with their weights to the XML file (weighted, not for partitions used in a FilteredAlignment) [optional]")
+
 (options,args) = parser.parse_args()
 
+if (options.patterns not in ["", "report", "weighted"]):
+	sys.stdout.write("ERROR! Unknown site pattern option %s (use report or weighted)\n" % options.patterns)
+	raise RuntimeError
+
 if (options.inputpath != ""):
 	config         = options.config
 	inputpath      = os.path.abspath(options.inputpath)+"/"
@@ -65,6 +121,8 @@ else:
 	config         = options.config[options.config.rfind("/")+1:]
 	inputpath      = os.path.abspath(options.config[:options.config.rfind("/")])+"/"
 
+cachepath = "" if options.nocache else os.path.abspath(os.path.expanduser(options.cachepath))
+
 ################################################################################################################################  
 
 
@@ -74,31 +132,144 @@ def writeAlignment(filename, output, msa_id="msa"):
       	Return dictionary with sequence ids and dates
       """
 
+      (seqids, lookup) = getSequenceLookup(filename)
+      with lookup:
+            for seqid in seqids:
+                  output.write('\t\t\t<sequence id="%s:%s" taxon="%s" totalcount="4" value="%s"/>\n' % (seqid, msa_id, seqid, lookup(seqid).decode()))
+
+      return getAlignmentDates(seqids)
+#
+
+def writePatternAlignment(filename, output, msa_id="msa"):
+      """
+      	Writes the unique site patterns of the alignment in BEAST format to output buffer
+      	(the weights of the patterns are added to the data element in the template)
+      	Return dictionary with sequence ids and dates
+      """
+
+      (seqids, matrix) = readAlignmentMatrix(filename)
+      patterns = compressSitePatterns(matrix)[0]
+      for i in range(0, len(seqids)):
+            output.write('\t\t\t<sequence id="%s:%s" taxon="%s" totalcount="4" value="%s"/>\n' % (seqids[i], msa_id, seqids[i], patterns[i].tobytes().decode()))
+
+      return getAlignmentDates(seqids)
+#
+
+def getAlignmentDates(seqids):
+      """
+      	Return dictionary with sequence ids and dates
+      """
+
       datedict = dict()
       tipdates = dict()
-      for seq in SeqIO.parse(filename, "fasta"):		
 
-            # Process date
-            datestring = seq.id.split('|')[-1]
-            (seqdate, sequpper, seqlower)  = getYearDate(datestring, datefmt = "%Y-%m-%d")
+      # Convert all dates at once (upper is the earliest and lower the latest possible date, as in getYearDate)
+      (dates, uppers, lowers) = getDecimalDates([seqid.split('|')[-1] for seqid in seqids], datefmt = "%Y-%m-%d")
+      invalid = [seqid for (seqid, seqdate) in zip(seqids, np.isnan(dates)) if seqdate]
+      if (len(invalid) > 0):
+            sys.stdout.write("ERROR! Sampling date could not be parsed for %d sequences: %s\n" % (len(invalid), ", ".join(invalid)))
+            raise RuntimeError
+      for (seqid, seqdate, sequpper, seqlower) in zip(seqids, dates.tolist(), uppers.tolist(), lowers.tolist()):
 
             #print("%s\t%f\t%f\t%f\n" % (datestring, seqdate, sequpper, seqlower))
 
             if (sequpper - seqlower != 0): 
-                sys.stdout.write("Estimating sampling date for: %s\n" % seq.id)
-                tipdates[seq.id] = [sequpper, seqlower]
+                sys.stdout.write("Estimating sampling date for: %s\n" % seqid)
+                tipdates[seqid] = [sequpper, seqlower]
             #
 
-            datedict[seq.id] = seqdate
-
-            # Write sequence
-            output.write('\t\t\t<sequence id="%s:%s" taxon="%s" totalcount="4" value="%s"/>\n' % (seq.id, msa_id, seq.id, seq.seq))
-
+            datedict[seqid] = seqdate
       #
 
       return({'datetrait' : datedict, 'tipdates' : tipdates})
 #
 
+def setAlignments(rendered):
+      """
+      	Add rendered alignments to the cache (inherited by forked worker processes)
+      """
+
+      alignments.update(rendered)
+#
+
+def getFileHash(filename, blocksize=2**20):
+      """
+      	Returns the SHA-1 hash of the contents of a file
+      """
+
+      sha = hashlib.sha1()
+      with open(filename, 'rb') as infile:
+            for block in iter(lambda: infile.read(blocksize), b""):
+                  sha.update(block)
+
+      return sha.hexdigest()
+#
+
+def writeCacheFile(cachefile, data):
+      """
+      	Write data to a json file in the cache
+      	Writes to a temporary file first, so other processes never read a partial file
+      """
+
+      os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+      with open(cachefile+".%d.tmp" % os.getpid(), 'w') as outfile:
+            json.dump(data, outfile)
+      os.replace(cachefile+".%d.tmp" % os.getpid(), cachefile)
+#
+
+def renderAlignment(filename, msa_id="msa", cachepath="", weighted=False):
+      """
+      	Returns the alignment (or only its unique site patterns if weighted) in BEAST format and 
+      	dictionary with sequence ids and dates
+
+      	If cachepath is given the rendered alignment is stored there, keyed by the hash of the 
+      	alignment file and the msa_id, and only rendered again if the alignment changes
+      """
+
+      if (cachepath != ""):
+            cachefile = "%s/%s.%s%s.v%d.json" % (cachepath, getFileHash(filename), msa_id, ".patterns" if weighted else "", CACHE_VERSION)
+            if (os.path.exists(cachefile)):
+                  sys.stdout.write("Using cached alignment for %s (%s)\n" % (filename, msa_id))
+                  with open(cachefile, 'r') as infile:
+                        cached = json.load(infile)
+                  return (cached['block'], {'datetrait' : cached['datetrait'], 'tipdates' : cached['tipdates']})
+
+      output = io.StringIO()
+      if (weighted):
+            dates = writePatternAlignment(filename, output, msa_id=msa_id)
+      else:
+            dates = writeAlignment(filename, output, msa_id=msa_id)
+      block  = output.getvalue()
+      output.close()
+
+      if (cachepath != ""):
+            writeCacheFile(cachefile, {'block' : block, 'datetrait' : dates['datetrait'], 'tipdates' : dates['tipdates']})
+
+      return (block, dates)
+#
+
+def getAlignment(filename, msa_id="msa", weighted=False):
+      """
+      	Returns the alignment in BEAST format and a copy of the dictionary with sequence ids and dates
+      	Every distinct alignment is only read and rendered once
+
+      	When streaming only the sequence ids are read and a function that writes the alignment to 
+      	an output file is returned instead of the rendered alignment
+      """
+
+      if (options.stream and not weighted):
+            (seqids, lookup) = getSequenceLookup(filename)
+            lookup.close()
+            return (partial(writeAlignment, filename, msa_id=msa_id), getAlignmentDates(seqids))
+
+      key = (os.path.abspath(filename), msa_id) + (("patterns",) if weighted else ())
+      if (key not in alignments):
+            alignments[key] = renderAlignment(filename, msa_id, cachepath, weighted)
+
+      (block, dates) = alignments[key]
+      return (block, {'datetrait' : dict(dates['datetrait']), 'tipdates' : dict((seqid, list(bounds)) for (seqid, bounds) in dates['tipdates'].items())})
+#
+
 def checkDateTraitsEqual(datetrait1, datetrait2):
 
       if (len(datetrait1.keys()) != len(datetrait2.keys())):
@@ -222,13 +393,112 @@ def getYearDate(datestring, datefmt = "%Y-%m-%d"):
 #
 
 
-def makeXMLFile(pars, template, outputpath=""):
+def splitTemplate(template):
+	"""
+		Split template into a list of (text, placeholder, format_spec, conversion) segments, 
+		as parsed by str.format
+	"""
+
+	return list(Formatter().parse(template))
+#
+
+
+def renderTemplate(segments, formatpars, output):
+	"""
+		Write the template segments to output, one segment at a time
+		Placeholders with a function as value (e.g. alignments) write themselves to output 
+	"""
+
+	formatter = Formatter()
+	for (text, field, spec, conversion) in segments:
+		output.write(text)
+		if (field is not None):
+			value = formatpars[field]
+			if (callable(value)):
+				value(output)
+			else:
+				output.write(formatter.format_field(formatter.convert_field(value, conversion), spec))
+#
+
+
+def compileTemplate(templatefile):
+	"""
+		Return the template split into segments and the set of placeholders in it
+
+		Compiled templates are cached in memory (until the template file changes)
+	"""
+
+	stat = os.stat(templatefile)
+	key  = (templatefile, stat.st_size, stat.st_mtime)
+	if (key not in templates):
+		segments = splitTemplate(open(templatefile, 'r').read())
+		templates[key] = {'segments' : segments, 'placeholders' : set(field for (text, field, spec, conversion) in segments if field is not None)}
+
+	return templates[key]
+#
+
+
+def getMissingPlaceholders(pars, template):
+	"""
+		Return the placeholders in a compiled template that are not in the config file or computed 
+		in formatPars
+	"""
+
+	provided = set(pars.keys()) | set(COMPUTED_PARS)
+	if ("origin_max" in pars.keys()):
+		provided |= set(["origin_min", "origin_init"])
+	if (isGrid(pars.get("samplingRateChangeTimes", ""))):
+		provided |= set(["samplingProportionDimension"])
+
+	return sorted(field for field in template['placeholders'] if field[1:] not in provided or field[0] != '$')
+#
+
+
+def getXMLName(name, seed=None):
+
+	return name+".xml" if seed is None else "%s_%d.xml" % (name, seed)
+#
+
+
+def getXMLFilename(outputpath, name, seed=None):
 
-	sys.stdout.write(pars["name"]+"...\n")
+	return outputpath+"/"+getXMLName(name, seed)+(".gz" if options.gzip else "")
+#
+
+
+def addSiteWeights(segments, msa_id, weights):
+	"""
+		Add the weights of the site patterns to the data element with id msa_id in the template segments
+		(an error if there is no such element)
+	"""
+
+	tag = '<data id="%s"' % msa_id
+	for i in range(0, len(segments)):
+		if (tag in segments[i][0]):
+			text = segments[i][0].replace(tag, tag+' weights="%s"' % ",".join(map(str, weights)), 1)
+			return segments[:i] + [(text,)+segments[i][1:]] + segments[i+1:]
+
+	# Without the weights every unique site pattern would be counted once
+	sys.stdout.write("ERROR! No <data id=\"%s\"> element in the template to add the site pattern weights to\n" % msa_id)
+	raise RuntimeError
+#
+
+
+def makeXMLFile(pars, template, outputpath="", seed=None, weights=dict()):
+	"""
+		Write the XML file for the parameters, template can be a string or a compiled template
+
+		If a seed is given the XML file is only for that seed ($(seed) in the template is replaced
+		by the seed, so log files have the same names as when BEAST replaces it)
+
+		weights are the weights of the site patterns of partitions that only have their 
+		unique site patterns in the XML file
+	"""
+
+	sys.stdout.write(pars["name"]+("..." if seed is None else " (seed %d)..." % seed)+"\n")
 	formatpars = dict()
 	for par in pars:
 		formatpars['$'+par] = pars[par]
-	output = template.format(**formatpars)
 
 	if (outputpath == ""):
 		outputpath = pars['outputpath']
@@ -236,25 +506,29 @@ def makeXMLFile(pars, template, outputpath=""):
 	if (not os.path.exists(outputpath)):
 		os.mkdir(outputpath)
 
-	outfile = open(outputpath+"/"+pars["name"]+".xml", 'w')
-	outfile.write(output)
+	segments = template['segments'] if isinstance(template, dict) else splitTemplate(template)
+	if (seed is not None):
+		segments = [(text.replace("$(seed)", str(seed)),)+segment[1:] for segment in segments for text in [segment[0]]]
+	for msa_id in weights:
+		segments = addSiteWeights(segments, msa_id, weights[msa_id])
+
+	if (options.gzip):
+		outfile = gzip.open(getXMLFilename(outputpath, pars["name"], seed), 'wt')
+	else:
+		outfile = open(getXMLFilename(outputpath, pars["name"], seed), 'w')
+	renderTemplate(segments, formatpars, outfile)
 	outfile.close()
 #
 
 
-def formatPars(pars):
+def formatPars(pars, weighted=[]):
 
-      output_align_ig  = io.StringIO()
-      output_align_cds = io.StringIO()
- 
-      dates_cds = writeAlignment(pars["alignment_cds"], output_align_cds, msa_id="cds")
-      pars["alignment_cds"] = output_align_cds.getvalue()      
+      (pars["alignment_cds"], dates_cds) = getAlignment(pars["alignment_cds"], msa_id="cds", weighted=("cds" in weighted))
 
       # Check that dates and sequence id's are equal
       if ("alignment_ig" in pars.keys()): 
-            dates_ig  = writeAlignment(pars["alignment_ig"],  output_align_ig, msa_id="ig")
+            (pars["alignment_ig"], dates_ig) = getAlignment(pars["alignment_ig"], msa_id="ig", weighted=("ig" in weighted))
             checkDateTraitsEqual(dates_ig['datetrait'], dates_cds['datetrait'])
-            pars["alignment_ig"]  = output_align_ig.getvalue()      
           
       
       # Tip dates
@@ -286,19 +560,31 @@ def formatPars(pars):
             maxdate = max(dates['datetrait'].values())
             pars['tmrca_mean'] = maxdate - pars['tmrca_mean']
 
-      output_align_ig.close()
-      output_align_cds.close()
       output_dates.close()
       output_tipDates.close()
       output_opTipDates.close()
       output_logTipDates.close()
 
 
+      # Sampling rate change times and empirical sampling proportions from the tip dates and case counts
+      if (isGrid(pars.get("samplingRateChangeTimes", "")) or pars.get("samplingProportion") == "empirical"):
+            (changetimes, proportions) = getSamplingGrid(pars, dates_cds['datetrait'])
+            if (pars.get("samplingProportionDimension", len(changetimes)) != len(changetimes)):
+                  sys.stdout.write("Warning: samplingProportionDimension (%s) does not match the number of sampling rate change times (%d), using %d\n" % (pars["samplingProportionDimension"], len(changetimes), len(changetimes)))
+
+            pars["samplingRateChangeTimes"]     = " ".join(map(str, changetimes))
+            pars["samplingProportionDimension"] = len(changetimes)
+            if (pars.get("samplingProportion") == "empirical"):
+                  pars["samplingProportion"] = proportions
+
       # BDSKY parameters
       pars["samplingSliceDim"]   = pars["samplingProportionDimension"]-1
       if ("samplingProportion" not in pars.keys()):
             pars["samplingProportion"] = 0.001
-      pars["samplingProportion"] = "0.0"+(" %.5f" % pars["samplingProportion"])*(pars["samplingProportionDimension"]-1)
+      if (isinstance(pars["samplingProportion"], list)):
+            pars["samplingProportion"] = "0.0"+"".join(" %.5f" % proportion for proportion in pars["samplingProportion"])
+      else:
+            pars["samplingProportion"] = "0.0"+(" %.5f" % pars["samplingProportion"])*(pars["samplingProportionDimension"]-1)
 
       
       # Set origin limits (if origin present)
@@ -308,50 +594,462 @@ def formatPars(pars):
             pars["origin_init"] = max(dates_cds['datetrait'].values())-getYearDate(str(pars['origin_init']))[0]
 #
 
+def getSamplingCaseFiles(pars):
+      """
+            Return the case files used for the sampling proportions of a config (cases_regions in 
+            the cases directory)
+      """
+
+      survpath = os.path.abspath(str(pars.get("cases", SAMPLING_CASES)))
+      regions  = pars.get("cases_regions", SAMPLING_REGIONS)
+      if (isinstance(regions, str)):
+            regions = regions.replace(","," ").split()
+
+      return (survpath, list(regions))
+#
+
+def getSamplingGrid(pars, datetrait):
+      """
+            Return the sampling rate change times (years before the most recent tip, as used with 
+            reverseTimeArrays) and the empirical sampling proportions in every interval (oldest 
+            interval first, without the interval before the oldest change time) for a config
+
+            samplingRateChangeTimes is either a grid (weekly, monthly, <n>bins or <n>quantiles) 
+            derived from the tip dates and case counts or a list of change times (returned as 
+            given). The grid and proportions are computed once per dataset.
+      """
+
+      (survpath, regions) = getSamplingCaseFiles(pars)
+      grid   = str(pars.get("samplingRateChangeTimes", "")).strip()
+      column = pars.get("cases_column", "combined")
+      key    = (os.path.abspath(pars["alignment_cds"]), survpath, tuple(regions), grid, column)
+
+      if (key not in samplinggrids):
+            yeardates = np.array(sorted(datetrait.values()))
+            maxdate   = yeardates[-1]
+            (casedays, cases) = getCases(survpath, regions)
+
+            if (isGrid(grid)):
+                  (breaks, bindays, proportions) = getGridProportions(casedays, cases, getDecimalDays(yeardates), grid)
+                  changetimes = [0.0] + (maxdate - breaks[:-1])[::-1].tolist()
+            else:
+                  # Keep the change times as typed, only the breaks for binning the cases are computed from them
+                  changetimes = grid.split()
+                  breaks      = maxdate - np.array(changetimes, dtype=float)[::-1]
+                  (breaks, bindays, proportions) = getGridProportions(casedays, cases, getDecimalDays(yeardates), breaks)
+            proportions = np.clip(proportions[column], SAMPLING_MINPROPORTION, 1.0).tolist()
+
+            sys.stdout.write("%s: %d sampling rate change times from %s (%s)\n" % (pars["name"], len(changetimes), pars.get("samplingRateChangeTimes"), ", ".join(regions)))
+            samplinggrids[key] = (changetimes, proportions)
+
+      return samplinggrids[key]
+#
+
 
 ################################################################################################################################  
 
-for filename in sorted(os.listdir(inputpath)):
-      if (fnmatch(filename,config)):
+def loadConfig(filename):
+      """
+            Load config file
+      """
+
+      configfile = open(inputpath+filename, 'r').read().replace("\t"," ")
+      return yaml.load(configfile)
+#
+
+def getOutputNames(pars):
+      """
+            Return the output path, the basename of the run scripts and the template file for a config
+      """
+
+      basename     = pars["name"] if options.name == '' else options.name
+      outputpath   = os.path.abspath(pars["outputpath"]  if options.outputpath == '' else options.outputpath)
+      templatefile = os.path.abspath(pars["template"] if options.template == '' else options.template)
 
-            # Load config file
-            configfile = open(inputpath+filename, 'r').read().replace("\t"," ")
-            pars 	     = yaml.load(configfile)	
+      return (outputpath, basename, templatefile)
+#
+
+def getSitePatterns(filename):
+      """
+            Return the number of sequences, sites and unique site patterns in an alignment (counted once per process)
+      """
 
-            # Set BEAST specific parameters
-            queue      = int(options.queue)
-            threads    = int(options.threads)
-            seeds      = list(map(int, options.seed.split(',')))
-            basename   = pars["name"] if options.name == '' else options.name
-            outputpath = os.path.abspath(pars["outputpath"]  if options.outputpath == '' else options.outputpath)
-            template   = open(os.path.abspath(pars["template"] if options.template == '' else options.template), 'r').read()
+      key = os.path.abspath(filename)
+      if (key not in sitepatterns):
+            sitepatterns[key] = countSitePatterns(key)
 
-            # Make output directory
-            if (not os.path.exists(outputpath)):
-                  os.makedirs(outputpath)
+      return sitepatterns[key]
+#
+
+def estimateResources(pars, template, threads=2):
+      """
+            Estimate the memory (MB), threads and wall time (hours) needed to run an XML file
             
-            # Set parameters not in the config file
-            formatPars(pars)
+            - Memory is dominated by the partial likelihoods: 2 buffers x (2 x taxa - 1) nodes x 
+              patterns x 4 states x 4 rate categories x 8 bytes (with a factor for JVM overhead)
+            - Threads are split over partitions and blocks of patterns, up to the maximum threads
+            - Wall time scales with the chain length x taxa x patterns / threads
+            - Only the alignments with a placeholder in the template are counted
+            
+            The constants (RESOURCE_*) are rough and can be calibrated from the wall times in the 
+            runbeast.py log.
+      """
+
+      alignments = [pars[par] for par in ["alignment_cds", "alignment_ig"] if par in pars.keys() and "$"+par in template['placeholders']]
+      counts     = [getSitePatterns(filename) for filename in alignments]
+      taxa       = max(count[0] for count in counts)
+      sites      = sum(count[1] for count in counts)
+      patterns   = sum(count[2] for count in counts)
+      partitions = max(1, sum(text.count('TreeLikelihood"') for (text, field, spec, conversion) in template['segments']))
+      chainlength = int(pars.get("chainlength", 0))
+
+      partials = 2.0 * (2*taxa - 1) * patterns * 4 * 4 * 8 / 2**20
+      memory   = int(math.ceil((RESOURCE_BASEMEMORY + RESOURCE_MEMORYFACTOR*partials)/256.0)*256)
+      threads  = max(1, min(threads, max(partitions, patterns // RESOURCE_PATTERNSPERTHREAD)))
+      walltime = int(max(1, math.ceil(RESOURCE_SECONDSPERUNIT * chainlength * taxa * patterns / threads / 3600)))
+
+      return {"name" : pars["name"], "taxa" : taxa, "partitions" : partitions, "sites" : sites, "patterns" : patterns, 
+              "chainlength" : chainlength, "memory" : memory, "threads" : threads, "walltime" : walltime}
+#
+
+def getPatternSummary(filename):
+      """
+            Return the number of sites, the weights of the unique site patterns and the first site of 
+            every pattern in an alignment (computed once per process)
+      """
+
+      key = os.path.abspath(filename)
+      if (key not in patternsummaries):
+            (seqids, matrix) = readAlignmentMatrix(key)
+            (patterns, weights, firstsites, sitepattern) = compressSitePatterns(matrix)
+            patternsummaries[key] = (matrix.shape[1], weights.tolist(), firstsites.tolist())
+
+      return patternsummaries[key]
+#
+
+def getFilteredPartitions(template):
+      """
+            Return the ids of all data elements used in a FilteredAlignment in the template
+      """
+
+      filtered = set()
+      for (text, field, spec, conversion) in template['segments']:
+            for element in re.findall(r'<data [^>]*FilteredAlignment[^>]*>', text):
+                  filtered.update(re.findall(r'data="@([^"]+)"', element))
+
+      return filtered
+#
+
+def reportSitePatterns(pars, template, outputpath):
+      """
+            Report the compression of every partition into site patterns and write the pattern 
+            summary to a csv file
+
+            Return the weights for all partitions that can be written as weighted patterns 
+      """
 
-            # Replace config file and save
-            #pars["name"] = basename+"_"+str(i)
-            makeXMLFile(pars, template, outputpath=outputpath)
+      filtered = getFilteredPartitions(template)
+      weights  = dict()
+      with open(outputpath+"/"+pars["name"]+".patterns.csv", 'w') as outfile:
+            outfile.write("partition,pattern,weight,firstsite\n")
+            for (par, msa_id) in [("alignment_cds", "cds"), ("alignment_ig", "ig")]:
+                  if (par not in pars.keys() or "$"+par not in template['placeholders']):
+                        continue
+
+                  (sites, patternweights, firstsites) = getPatternSummary(pars[par])
+                  sys.stdout.write("%s: %d sites, %d site patterns (%.1fx compression)\n" % (msa_id, sites, len(patternweights), float(sites)/max(len(patternweights), 1)))
+                  for i in range(0, len(patternweights)):
+                        outfile.write("%s,%d,%d,%d\n" % (msa_id, i+1, patternweights[i], firstsites[i]+1))
+
+                  if (options.patterns == "weighted"):
+                        if (msa_id in filtered):
+                              sys.stdout.write("Warning: %s is used in a FilteredAlignment, writing all sites\n" % msa_id)
+                        else:
+                              weights[msa_id] = patternweights
+
+      return weights
+#
 
-            # Output scripts
-            scriptfile = open(outputpath+"/"+basename+".sh",'a')
-            eulerfile  = open(outputpath+"/"+basename+".euler.sh",'a')
+def makeConfig(filename):
+      """
+            Make the XML file for one config file and return the lines for the run scripts
+      """
 
-            scriptfile.write("# %s \n" % filename)
-            eulerfile.write("# %s \n" % filename)
+      pars = loadConfig(filename)
 
+      # Set BEAST specific parameters
+      queue      = int(options.queue)
+      threads    = int(options.threads)
+      seeds      = list(map(int, options.seed.split(',')))
+      (outputpath, basename, templatefile) = getOutputNames(pars)
+      template   = compileTemplate(templatefile)
+
+      # Make output directory
+      if (not os.path.exists(outputpath)):
+            os.makedirs(outputpath, exist_ok=True)
+      
+      # Resources for the runs
+      if (options.estimate):
+            resources = estimateResources(pars, template, threads)
+            (queue, threads, memory) = (resources["walltime"], resources["threads"], resources["memory"])
+            javamem = "-Xms%dM -Xmx%dM" % (memory//2, memory)
+      else:
+            (memory, javamem) = (4096, "-Xms2G -Xmx4G")
+
+      # Site patterns
+      weights = reportSitePatterns(pars, template, outputpath) if options.patterns != "" else dict()
+
+      # Set parameters not in the config file
+      formatPars(pars, weighted=list(weights.keys()))
+
+      # Replace config file and save
+      #pars["name"] = basename+"_"+str(i)
+      if (options.replicates):
             for seed in seeds:
-                  cmd ="java -jar -Xms2G -Xmx4G $1 -overwrite -seed %d -threads %d %s" % (seed, threads, pars["name"]+".xml") 
-                  scriptfile.write("nohup %s > %s_%d.out &\n" % (cmd, pars["name"], seed))
-                  eulerfile.write("bsub -W%s:0 -n %d -o %s_%d.euler.out -R 'rusage[mem=4096]' %s\n" % (queue, threads, pars["name"], seed, cmd))
-
-            scriptfile.write("\n")
-            eulerfile.write("\n")
-            scriptfile.close()
-            eulerfile.close()
-      #
+                  makeXMLFile(pars, template, outputpath=outputpath, seed=seed, weights=weights)
+      else:
+            makeXMLFile(pars, template, outputpath=outputpath, weights=weights)
+
+      # Output scripts
+      script = ["# %s \n" % filename]
+      euler  = ["# %s \n" % filename]
+      local  = ["# %s \n" % filename]
+      for seed in seeds:
+            if (options.replicates):
+                  cmd ="java -jar %s $1 -overwrite -seed %d -threads %d -statefile %s_%d.state %s" % (javamem, seed, threads, pars["name"], seed, getXMLName(pars["name"], seed)) 
+            else:
+                  cmd ="java -jar %s $1 -overwrite -seed %d -threads %d %s" % (javamem, seed, threads, pars["name"]+".xml") 
+            script.append("nohup %s > %s_%d.out &\n" % (cmd, pars["name"], seed))
+            euler.append("bsub -W%s:0 -n %d -o %s_%d.euler.out -R 'rusage[mem=%d]' %s\n" % (queue, threads, pars["name"], seed, memory, cmd))
+            local.append("throttle %d; %s > %s_%d.out 2>&1 & THREADS[$!]=%d\n" % (threads, cmd, pars["name"], seed, threads))
+      script.append("\n")
+      euler.append("\n")
+      local.append("\n")
+
+      scripts = {".sh" : "".join(script), ".euler.sh" : "".join(euler)}
+      if (options.replicates):
+            scripts[".local.sh"] = "".join(local)
+      if (options.estimate):
+            scripts[".resources.csv"] = ",".join(str(resources[field]) for field in RESOURCE_FIELDS)+"\n"
+
+      return (outputpath+"/"+basename, scripts)
+#
+
+def getLocalScriptHeader():
+      """
+            Return the header of the script that runs chains on the local machine, starting a chain 
+            only when its threads fit in the cores next to the threads of the running chains
+      """
+
+      return ("#!/bin/bash\n"
+              "# Run chains on the local machine, as many at a time as their threads fit in the cores\n"
+              "# Usage: ./script.local.sh beast.jar [cores]\n"
+              "CORES=${2:-$(nproc)}\n"
+              "declare -A THREADS\n"
+              "throttle() {\n"
+              "\twhile true; do\n"
+              "\t\tUSED=0\n"
+              "\t\tfor pid in $(jobs -rp); do USED=$(( USED + ${THREADS[$pid]:-1} )); done\n"
+              "\t\tif [ $USED -eq 0 ] || [ $(( USED + $1 )) -le $CORES ]; then break; fi\n"
+              "\t\twait -n\n"
+              "\tdone\n"
+              "}\n"
+              "trap wait EXIT\n\n")
+#
+
+def writeScripts(scriptname, scripts, mode='a'):
+      """
+            Write (or append) the lines for the run scripts, adding the header to new local scripts
+      """
+
+      for suffix in scripts:
+            header = (suffix in [".local.sh", ".resources.csv"] and (mode == 'w' or not os.path.exists(scriptname+suffix)))
+            with open(scriptname+suffix, mode) as outfile:
+                  if (header and suffix == ".local.sh"):
+                        outfile.write(getLocalScriptHeader())
+                  elif (header):
+                        outfile.write(",".join(RESOURCE_FIELDS)+"\n")
+                  outfile.write(scripts[suffix])
+
+            if (header and suffix == ".local.sh"):
+                  os.chmod(scriptname+suffix, 0o755)
+#
+
+def makeConfigs(configs, jobs=1):
+      """
+            Make the XML files for a list of config files, using jobs processes, and return the lines 
+            for the run scripts in the same order as the config files
+      """
+
+      if (jobs > 1 and len(configs) > 1 and not options.stream and options.patterns != "weighted"):
+
+            # Read and render every distinct alignment once, then share with the workers
+            keys = []
+            for filename in configs:
+                  pars = loadConfig(filename)
+                  for (par, msa_id) in [("alignment_cds", "cds"), ("alignment_ig", "ig")]:
+                        if (par in pars.keys() and (os.path.abspath(pars[par]), msa_id) not in keys):
+                              keys.append((os.path.abspath(pars[par]), msa_id))
+
+            with multiprocessing.Pool(min(jobs, len(keys))) as pool:
+                  setAlignments(zip(keys, pool.starmap(renderAlignment, [key+(cachepath,) for key in keys])))
+
+            # Forked workers inherit the rendered alignments from the module cache without pickling them,
+            # with other start methods workers render (or load from the cache) the alignments they need
+            context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+            with context.Pool(min(jobs, len(configs))) as pool:
+                  return pool.map(makeConfig, configs, chunksize=1)
+      elif (jobs > 1 and len(configs) > 1):
+
+            # Streaming (or weighted patterns), every worker renders its own alignments
+            with multiprocessing.Pool(min(jobs, len(configs))) as pool:
+                  return pool.map(makeConfig, configs, chunksize=1)
+      else:
+            return map(makeConfig, configs)
+#
+
+def getFingerprint(filename, pars, previous=dict()):
+      """
+            Return the fingerprint of all inputs of a config file (config, template, alignments and 
+            run options). Files are only hashed again if their size or modification time changed 
+            since the previous fingerprint
+      """
+
+      (outputpath, basename, templatefile) = getOutputNames(pars)
+
+      paths = [inputpath+filename, templatefile] + [os.path.abspath(pars[par]) for par in ["alignment_cds", "alignment_ig", "datetrait"] if par in pars.keys()]
+      if (isGrid(pars.get("samplingRateChangeTimes", "")) or pars.get("samplingProportion") == "empirical"):
+            (survpath, regions) = getSamplingCaseFiles(pars)
+            paths += [survpath+"/"+region+".csv" for region in regions]
+
+      files = dict()
+      for path in paths:
+            stat = os.stat(path)
+            old  = previous.get(path, dict())
+            if (old.get("size") == stat.st_size and old.get("mtime") == stat.st_mtime):
+                  files[path] = old
+            else:
+                  files[path] = {"size" : stat.st_size, "mtime" : stat.st_mtime, "sha1" : getFileHash(path)}
+
+      return {"files" : files, "seed" : options.seed, "threads" : options.threads, "queue" : options.queue, "replicates" : bool(options.replicates), "estimate" : bool(options.estimate), "patterns" : options.patterns}
+#
+
+def sameFingerprint(fingerprint1, fingerprint2):
+      """
+            Check if two fingerprints have the same inputs (ignoring modification times)
+      """
+
+      hashes1 = dict((path, fingerprint1["files"][path]["sha1"]) for path in fingerprint1["files"])
+      hashes2 = dict((path, fingerprint2["files"][path]["sha1"]) for path in fingerprint2["files"])
+
+      return (hashes1 == hashes2 and all(fingerprint1.get(key) == fingerprint2.get(key) for key in ["seed", "threads", "queue", "replicates", "estimate", "patterns"]))
+#
+
+def readManifest(scriptname):
+      """
+            Read the manifest of XML files made for a set of run scripts (empty if it doesn't exist)
+      """
+
+      if (os.path.exists(scriptname+".manifest.json")):
+            with open(scriptname+".manifest.json", 'r') as infile:
+                  return json.load(infile)
+      else:
+            return dict()
+#
+
+def writeManifest(scriptname, manifest):
+      """
+            Write the manifest and the run scripts for all XML files in it
+      """
+
+      with open(scriptname+".manifest.json", 'w') as outfile:
+            json.dump(manifest, outfile, indent=1)
+
+      scripts = dict()
+      for entry in manifest.values():
+            for suffix in entry["scripts"]:
+                  scripts[suffix] = scripts.get(suffix, "") + entry["scripts"][suffix]
+
+      writeScripts(scriptname, scripts, mode='w')
+#
+
+
+################################################################################################################################  
+
+alignments    = dict()
+templates     = dict()
+sitepatterns  = dict()
+patternsummaries = dict()
+samplinggrids = dict()
+CACHE_VERSION = 1
+
+# Resource estimates (rough, calibrate with the wall times in the runbeast.py log)
+RESOURCE_FIELDS            = ["name", "taxa", "partitions", "sites", "patterns", "chainlength", "memory", "threads", "walltime"]
+RESOURCE_BASEMEMORY        = 512
+RESOURCE_MEMORYFACTOR      = 1.5
+RESOURCE_PATTERNSPERTHREAD = 1000
+RESOURCE_SECONDSPERUNIT    = 1e-9
+
+# Case counts for sampling grids and empirical sampling proportions (if not in the config file)
+SAMPLING_CASES         = "../data/cases/"
+SAMPLING_REGIONS       = ["guinea_cases", "liberia_cases", "sierraleone_cases"]
+SAMPLING_MINPROPORTION = 1e-5
+
+# Parameters computed in formatPars (not in the config files)
+COMPUTED_PARS = ["datetrait", "tipdatesPriors", "tipdatesOperators", "tipdatesLoggers", "samplingSliceDim", "samplingProportion"]
+
+if __name__ == "__main__":
+
+      jobs    = int(options.jobs)
+      configs = [filename for filename in sorted(os.listdir(inputpath)) if fnmatch(filename, config)]
+
+      # Check that all placeholders in the templates are provided before making any XML files
+      errors = 0
+      for filename in configs:
+            pars    = loadConfig(filename)
+            missing = getMissingPlaceholders(pars, compileTemplate(getOutputNames(pars)[2]))
+            if (len(missing) > 0):
+                  sys.stdout.write("ERROR! Placeholders in template not provided by %s: %s\n" % (filename, ", ".join("{"+field+"}" for field in missing)))
+                  errors += 1
+
+      if (errors > 0):
+            raise RuntimeError("%d config files do not provide all placeholders in their templates" % errors)
+
+      if (options.incremental):
+
+            # Only remake XML files with changed inputs
+            manifests = dict()
+            changed   = []
+            for filename in configs:
+                  pars = loadConfig(filename)
+                  (outputpath, basename, templatefile) = getOutputNames(pars)
+                  scriptname = outputpath+"/"+basename
+                  if (scriptname not in manifests):
+                        manifests[scriptname] = readManifest(scriptname)
+
+                  entry       = manifests[scriptname].get(pars["name"], dict())
+                  fingerprint = getFingerprint(filename, pars, entry["fingerprint"]["files"] if "fingerprint" in entry else dict())
+                  if ("fingerprint" in entry and sameFingerprint(entry["fingerprint"], fingerprint) and os.path.exists(getXMLFilename(outputpath, pars["name"], int(options.seed.split(',')[0]) if options.replicates else None))):
+                        sys.stdout.write("%s unchanged\n" % pars["name"])
+                        entry["fingerprint"] = fingerprint
+                  else:
+                        changed.append((filename, pars["name"], fingerprint))
+
+            results = makeConfigs([filename for (filename, name, fingerprint) in changed], jobs)
+            for ((filename, name, fingerprint), (scriptname, scripts)) in zip(changed, results):
+                  manifests[scriptname][name] = {"config" : inputpath+filename, "fingerprint" : fingerprint, "scripts" : scripts}
+
+            # Drop XML files of config files that no longer exist (entries from other input paths are kept)
+            for scriptname in manifests:
+                  for name in [name for name in manifests[scriptname] if not os.path.exists(manifests[scriptname][name]["config"])]:
+                        sys.stdout.write("%s removed from %s\n" % (name, scriptname+".manifest.json"))
+                        del manifests[scriptname][name]
+                  writeManifest(scriptname, manifests[scriptname])
+
+            sys.stdout.write("%d of %d XML files made\n" % (len(changed), len(configs)))
+      else:
+
+            # Append to run scripts in config order (only written by this process)
+            for (scriptname, scripts) in makeConfigs(configs, jobs):
+                  writeScripts(scriptname, scripts)
 #
@@ -1,84 +1,186 @@
 import os, sys, time, collections
+import numpy as np
 from optparse import OptionParser
-from Bio import AlignIO
+from alignutils import readAlignmentMatrix, readMSA, getUpperTable
 
 
 # Get counts for characters in columns of MSA
 ################################################################################################################################
-# Parameters
+#
+# - The alignment is read once into a (sequences x columns) uint8 matrix and the counts for all
+#   characters in the alphabet are computed for all columns at once
+# - The old column-by-column loop (-l) is still available and -b compares the two
+#
+################################################################################################################################
 
-usage = "usage: %prog [option]"
-parser = OptionParser(usage=usage)
+alphabet   = ["A", "C", "G", "T", "R", "Y", "W", "S", "K", "M", "D", "V", "H", "B", "N", "-", "?"]
 
-parser.add_option("-i","--inputfile",
-                  dest = "inputfile",
-                  default = "",
-                  metavar = "path",
-                  help = "Path to input alignment [required]")
 
-parser.add_option("-o","--outputpath",
-                  dest = "outputpath",
-                  default = "",
-                  metavar = "path",
-                  help = "Path to save output file in [required]")
+def getColumnHistogram(matrix, alphabet=alphabet, normalise=False, chunksize=4096, verbose=True):
+	"""Return a (columns x alphabet) matrix with the counts of each character in each column of
+	   the alignment matrix (lower case characters are counted as upper case)
 
-parser.add_option("-n","--normalise",
-                  dest = "normalise",
-                  action = "store_true",
-                  help = "Normalise each column in the alignment [default: %default] [optional]")
+	   Rows are processed in chunks, so at most chunksize rows are case-folded at a time
+	"""
 
-(options,args) = parser.parse_args()
+	(nseqs, ncols) = matrix.shape
+	upper  = getUpperTable()
+	codes  = np.array([ord(c) for c in alphabet], dtype=np.uint8)
+	hist   = np.zeros((ncols, len(alphabet)), dtype=np.int64)
+	totals = np.zeros(256, dtype=np.int64)
 
-inputfile  = os.path.abspath(options.inputfile)
-outputpath = os.path.abspath(options.outputpath)+"/"
-normalise  = options.normalise
-alphabet   = ["A", "C", "G", "T", "R", "Y", "W", "S", "K", "M", "D", "V", "H", "B", "N", "-", "?"]
+	for start in range(0, nseqs, chunksize):
+		chunk   = upper[matrix[start:start+chunksize]]
+		present = np.bincount(chunk.ravel(), minlength=256)
+		totals += present
 
+		for j in range(0, len(codes)):
+			if (present[codes[j]] > 0):
+				hist[:,j] += np.count_nonzero(chunk == codes[j], axis=0)
 
-################################################################################################################################
-start = time.time()
-
-if (not os.path.exists(outputpath)):
-    os.mkdir(outputpath)
-
-outfile = open(outputpath+inputfile[inputfile.rfind("/")+1:inputfile.rfind(".")]+".hist.csv","w")
-outfile.write(",".join(alphabet)+"\n")    
-
-msa = AlignIO.read(inputfile, "fasta")
-for i in range(0, msa.get_alignment_length()):
-	col = msa[:,i]
-
-	# Old slow way to get column histogram
- 	#coldict = dict((c, col.count(c)) for c in col)
-
- 	# Faster way
-	coldict = collections.Counter(col.upper())
- 	
- 	# Mising characters not in alphabet
-	for c in coldict.keys():
-		if (c not in alphabet):
-			sys.stdout.write(c+" not in alphabet!\n")
-
-	total = 0
-	line  = []
-	for c in alphabet:
-		if (c in coldict.keys()):
-			line.append(coldict[c])
-			total += coldict[c]
-		else:
-			line.append(0)
+	# Mising characters not in alphabet
+	if (verbose):
+		for c in np.flatnonzero(totals):
+			if (c not in codes):
+				sys.stdout.write("%s not in alphabet! (%d occurrences)\n" % (chr(c), totals[c]))
 
 	if (normalise):
-		for i in range(0,len(line)):
-			line[i] /= total
+		return hist/hist.sum(axis=1, keepdims=True)
+	else:
+		return hist
+#
+
+
+def getColumnHistogramLoop(msa, alphabet=alphabet, normalise=False):
+	"""Return a list with the counts of each character in each column of the alignment,
+	   calculated one column at a time (slow)
+
+	"""
+
+	hist = []
+	for i in range(0, msa.get_alignment_length()):
+		col = msa[:,i]
+
+		# Old slow way to get column histogram
+	 	#coldict = dict((c, col.count(c)) for c in col)
+
+	 	# Faster way
+		coldict = collections.Counter(col.upper())
+
+	 	# Mising characters not in alphabet
+		for c in coldict.keys():
+			if (c not in alphabet):
+				sys.stdout.write(c+" not in alphabet!\n")
+
+		total = 0
+		line  = []
+		for c in alphabet:
+			if (c in coldict.keys()):
+				line.append(coldict[c])
+				total += coldict[c]
+			else:
+				line.append(0)
+
+		if (normalise):
+			for i in range(0,len(line)):
+				line[i] /= total
+
+		hist.append(line)
+	#
+
+	return(hist)
+#
+
 
-	outfile.write(",".join(map(str, line))+"\n")
-	#sys.stdout.write("\t".join(map(str, line))+"\t"+str(total)+"\n")
+def writeHistogram(hist, filename, alphabet=alphabet):
+	"""Write the histogram to a csv file with the alphabet as header
+
+	"""
+
+	if (isinstance(hist, np.ndarray)):
+		hist = hist.tolist()
+
+	outfile = open(filename,"w")
+	outfile.write(",".join(alphabet)+"\n")
+	for line in hist:
+		outfile.write(",".join(map(str, line))+"\n")
+	outfile.close()
 #
-outfile.close()
 
-end = time.time()
-sys.stdout.write("Total time taken: "+str(end-start)+" seconds\n")
 
+################################################################################################################################
+
+if __name__ == "__main__":
+
+	################################################################################################################################
+	# Parameters
+
+	usage = "usage: %prog [option]"
+	parser = OptionParser(usage=usage)
+
+	parser.add_option("-i","--inputfile",
+	                  dest = "inputfile",
+	                  default = "",
+	                  metavar = "path",
+	                  help = "Path to input alignment (fasta or packed) [required]")
+
+	parser.add_option("-o","--outputpath",
+	                  dest = "outputpath",
+	                  default = "",
+	                  metavar = "path",
+	                  help = "Path to save output file in [required]")
+
+	parser.add_option("-n","--normalise",
+	                  dest = "normalise",
+	                  action = "store_true",
+	                  help = "Normalise each column in the alignment [default: %default] [optional]")
+
+	parser.add_option("-l","--loop",
+	                  dest = "loop",
+	                  action = "store_true",
+	                  help = "Use the old column-by-column loop instead of the vectorized histogram [default: %default] [optional]")
+
+	parser.add_option("-b","--benchmark",
+	                  dest = "benchmark",
+	                  action = "store_true",
+	                  help = "Time the vectorized histogram against the column-by-column loop and check that they agree [default: %default] [optional]")
+
+	(options,args) = parser.parse_args()
+
+	inputfile  = os.path.abspath(options.inputfile)
+	outputpath = os.path.abspath(options.outputpath)+"/"
+	normalise  = options.normalise
+
+
+	################################################################################################################################
+	start = time.time()
+
+	if (not os.path.exists(outputpath)):
+		os.mkdir(outputpath)
+
+	outputfile = outputpath+inputfile[inputfile.rfind("/")+1:inputfile.rfind(".")]+".hist.csv"
+
+	if (options.benchmark):
+		t0 = time.time()
+		msa = readMSA(inputfile)
+		histloop = getColumnHistogramLoop(msa, normalise=normalise)
+		t1 = time.time()
+		(ids, matrix) = readAlignmentMatrix(inputfile)
+		hist = getColumnHistogram(matrix, normalise=normalise)
+		t2 = time.time()
+
+		sys.stdout.write("Alignment: %d sequences x %d columns\n" % matrix.shape)
+		sys.stdout.write("Column loop  : %10.4f seconds\n" % (t1-t0))
+		sys.stdout.write("Vectorized   : %10.4f seconds (%.1fx faster)\n" % (t2-t1, (t1-t0)/max(t2-t1, 1e-9)))
+		sys.stdout.write("Histograms identical: %s\n" % (hist.tolist() == histloop))
+	elif (options.loop):
+		msa  = readMSA(inputfile)
+		hist = getColumnHistogramLoop(msa, normalise=normalise)
+	else:
+		(ids, matrix) = readAlignmentMatrix(inputfile)
+		hist = getColumnHistogram(matrix, normalise=normalise)
 
+	writeHistogram(hist, outputfile)
 
+	end = time.time()
+	sys.stdout.write("Total time taken: "+str(end-start)+" seconds\n")
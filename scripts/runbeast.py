@@ -0,0 +1,315 @@
+import os, sys, re, csv, time, shlex, subprocess
+from fnmatch import fnmatch
+from optparse import OptionParser
+from fileutils import parseList
+
+
+# Run BEAST analyses on the local machine
+################################################################################################################################
+#
+# - Runs every XML file in the input path for every seed (or every per-seed XML file made with
+#   makeBeastXML.py -r) and starts new jobs as long as the threads and memory of the running jobs
+#   fit in the budget of the machine
+# - Jobs with a state file are resumed instead of started from scratch, and jobs that finished
+#   successfully (according to the log) are skipped, so the scheduler can be restarted after an
+#   interruption
+# - The start time, wall time and exit status of every job is appended to a csv log
+# - The command is a template, so e.g. a stub can be used instead of java for testing
+#
+################################################################################################################################
+
+COMMAND = "java -Xms{minmemory}M -Xmx{memory}M -jar {beast} {mode} -seed {seed} -threads {threads} -statefile {statefile} {xml}"
+
+LOGFIELDS = ["xml", "seed", "threads", "memory", "mode", "start", "walltime", "status"]
+
+
+def getTotalMemory():
+	"""Return the physical memory of the machine in MB
+
+	"""
+
+	return int(os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")/2**20)
+#
+
+
+def readResources(filename):
+	"""Read the resource estimates made by makeBeastXML.py -E and return a dictionary with the
+	threads and memory for every XML name
+
+	"""
+
+	resources = dict()
+	with open(filename, "r") as infile:
+		for row in csv.DictReader(infile):
+			resources[row["name"]] = {"threads" : int(row["threads"]), "memory" : int(row["memory"])}
+
+	return resources
+#
+
+
+def getJobs(inputpath, pattern="*.xml", seeds=[127], replicates=False, threads=2, memory=4096, resources=dict()):
+	"""Return a list of jobs (dictionaries) for all XML files in inputpath matching the pattern
+
+	If replicates is True every XML file is for one seed (name_seed.xml, as made by
+	makeBeastXML.py -r), otherwise every XML file is run once for every seed. Jobs use the threads
+	and memory in resources (if their XML name is in it) or the default threads and memory.
+
+	"""
+
+	jobs = []
+	for xml in sorted(os.listdir(inputpath)):
+		if (not fnmatch(xml, pattern)):
+			continue
+
+		name = xml[:xml.rfind(".xml")]
+		if (replicates):
+			match = re.match(r"^(.*)_(\d+)$", name)
+			if (match is None):
+				sys.stdout.write("Warning: No seed in the name of %s, skipping\n" % xml)
+				continue
+			xmlseeds = [int(match.group(2))]
+			base     = match.group(1)
+		else:
+			xmlseeds = seeds
+			base     = name
+
+		budget = resources.get(base, {"threads" : threads, "memory" : memory})
+
+		for seed in xmlseeds:
+			jobname = name if replicates else "%s_%d" % (name, seed)
+			jobs.append({"xml" : xml, "seed" : seed, "name" : jobname, "statefile" : jobname+".state",
+			             "threads" : budget["threads"], "memory" : budget["memory"]})
+
+	return jobs
+#
+
+
+def readLog(logfile):
+	"""Return the set of (xml, seed) pairs of jobs that finished successfully according to the log
+
+	"""
+
+	finished = set()
+	if (os.path.exists(logfile)):
+		with open(logfile, "r") as infile:
+			for row in csv.DictReader(infile):
+				if (row["status"] == "0"):
+					finished.add((row["xml"], int(row["seed"])))
+
+	return finished
+#
+
+
+def startJob(job, inputpath, command, beast, overwrite=False):
+	"""Start the command for a job in inputpath and return the process
+
+	The job is resumed if its state file exists (unless overwrite is True). The output of the
+	command is written to name.out.
+
+	"""
+
+	job["mode"]  = "-resume" if (not overwrite and os.path.exists(inputpath+job["statefile"])) else "-overwrite"
+	job["start"] = time.time()
+
+	cmd = command.format(beast=beast, xml=job["xml"], seed=job["seed"], threads=job["threads"], memory=job["memory"],
+	                     minmemory=max(job["memory"]//2, 1), statefile=job["statefile"], mode=job["mode"], name=job["name"])
+	sys.stdout.write("Starting %s (seed %d, %s): %s\n" % (job["xml"], job["seed"], job["mode"], cmd))
+
+	with open(inputpath+job["name"]+".out", "a" if job["mode"] == "-resume" else "w") as outfile:
+		return subprocess.Popen(shlex.split(cmd), cwd=inputpath, stdout=outfile, stderr=subprocess.STDOUT)
+#
+
+
+def logJob(job, status, logfile):
+	"""Append the wall time and exit status of a job to the log
+
+	"""
+
+	new = not os.path.exists(logfile)
+	with open(logfile, "a") as outfile:
+		writer = csv.DictWriter(outfile, fieldnames=LOGFIELDS, extrasaction="ignore")
+		if (new):
+			writer.writeheader()
+		writer.writerow(dict(job, start=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["start"])),
+		                          walltime="%.2f" % (time.time()-job["start"]), status=status))
+#
+
+
+def runJobs(jobs, inputpath, command=COMMAND, beast="beast.jar", cores=None, memory=None, maxjobs=0,
+	        overwrite=False, logfile="", interval=1.0):
+	"""Run jobs with as many running at the same time as fit in the threads (cores) and memory
+	budgets (and at most maxjobs, if > 0). At least one job is always run.
+
+	Return the number of jobs that failed.
+
+	"""
+
+	cores   = os.cpu_count() if cores is None else cores
+	memory  = getTotalMemory() if memory is None else memory
+	pending = list(jobs)
+	running = []
+	failed  = 0
+
+	try:
+		while (len(pending) > 0 or len(running) > 0):
+
+			# Start jobs while they fit in the budget
+			while (len(pending) > 0):
+				job = pending[0]
+				usedthreads = sum(j["threads"] for (j, process) in running)
+				usedmemory  = sum(j["memory"]  for (j, process) in running)
+				if (len(running) > 0 and (usedthreads + job["threads"] > cores or usedmemory + job["memory"] > memory or
+					                      (maxjobs > 0 and len(running) >= maxjobs))):
+					break
+				running.append((job, startJob(pending.pop(0), inputpath, command, beast, overwrite)))
+
+			time.sleep(interval)
+
+			# Collect finished jobs
+			for (job, process) in list(running):
+				status = process.poll()
+				if (status is not None):
+					running.remove((job, process))
+					sys.stdout.write("Finished %s (seed %d) with exit status %d after %.2f seconds\n" % (job["xml"], job["seed"], status, time.time()-job["start"]))
+					logJob(job, status, logfile)
+					failed += (status != 0)
+	except KeyboardInterrupt:
+		sys.stdout.write("Interrupted, stopping %d running jobs (they will be resumed on the next run)\n" % len(running))
+		for (job, process) in running:
+			process.terminate()
+			process.wait()
+			logJob(job, "interrupted", logfile)
+		raise
+
+	return failed
+#
+
+
+################################################################################################################################
+
+if __name__ == "__main__":
+
+	################################################################################################################################
+	# Parameters
+
+	usage = "usage: %prog [option]"
+	parser = OptionParser(usage=usage)
+
+	parser.add_option("-i","--inputpath",
+	                  dest = "inputpath",
+	                  default = "",
+	                  metavar = "path",
+	                  help = "Path with XML files (jobs are run in this directory) [required]")
+
+	parser.add_option("-x","--pattern",
+	                  dest = "pattern",
+	                  default = "*.xml",
+	                  metavar = "string",
+	                  help = "Pattern to match for XML files [default: %default]")
+
+	parser.add_option("-b","--beast",
+	                  dest = "beast",
+	                  default = "beast.jar",
+	                  metavar = "path",
+	                  help = "Path to BEAST jar file [default: %default]")
+
+	parser.add_option("-s","--seed",
+	                  dest = "seed",
+	                  default = "127",
+	                  metavar = "integer",
+	                  help = "Seed or comma separated list of seeds to use [default: %default]")
+
+	parser.add_option("-r","--replicates",
+	                  dest = "replicates",
+	                  action = "store_true",
+	                  help = "XML files are for one seed each (made with makeBeastXML.py -r) [default: %default]")
+
+	parser.add_option("-t","--threads",
+	                  dest = "threads",
+	                  default = "2",
+	                  metavar = "integer",
+	                  help = "Threads per job [default: %default]")
+
+	parser.add_option("-m","--memory",
+	                  dest = "memory",
+	                  default = "4096",
+	                  metavar = "integer",
+	                  help = "Memory per job in MB [default: %default]")
+
+	parser.add_option("-R","--resources",
+	                  dest = "resources",
+	                  default = "",
+	                  metavar = "path",
+	                  help = "Resource estimates from makeBeastXML.py -E (name.resources.csv) with the threads and memory for every job [optional]")
+
+	parser.add_option("-c","--cores",
+	                  dest = "cores",
+	                  default = "",
+	                  metavar = "integer",
+	                  help = "Total number of threads for all running jobs [default: number of cores]")
+
+	parser.add_option("-M","--totalmemory",
+	                  dest = "totalmemory",
+	                  default = "",
+	                  metavar = "integer",
+	                  help = "Total memory in MB for all running jobs [default: physical memory]")
+
+	parser.add_option("-j","--jobs",
+	                  dest = "jobs",
+	                  default = "0",
+	                  metavar = "integer",
+	                  help = "Maximum number of jobs running at the same time (0 for no limit) [default: %default]")
+
+	parser.add_option("-f","--force",
+	                  dest = "force",
+	                  action = "store_true",
+	                  help = "Run all jobs from scratch, even if they finished or have state files [default: %default]")
+
+	parser.add_option("-l","--logfile",
+	                  dest = "logfile",
+	                  default = "runbeast.csv",
+	                  metavar = "path",
+	                  help = "Log file with wall time and exit status of every job (relative to the input path) [default: %default]")
+
+	parser.add_option("-C","--command",
+	                  dest = "command",
+	                  default = COMMAND,
+	                  metavar = "string",
+	                  help = "Command template to run for every job (e.g. a stub instead of java for testing) [default: %default]")
+
+	parser.add_option("-p","--poll",
+	                  dest = "poll",
+	                  default = "1",
+	                  metavar = "float",
+	                  help = "Seconds between checking running jobs [default: %default]")
+
+	(options,args) = parser.parse_args()
+
+	inputpath = os.path.abspath(options.inputpath)+"/"
+	beast     = os.path.abspath(options.beast)
+	logfile   = os.path.join(inputpath, options.logfile)
+	seeds     = parseList(options.seed, int)
+
+
+	################################################################################################################################
+	start = time.time()
+
+	resources = readResources(options.resources) if options.resources != "" else dict()
+	jobs = getJobs(inputpath, options.pattern, seeds, options.replicates, int(options.threads), int(options.memory), resources)
+	if (not options.force):
+		finished = readLog(logfile)
+		skipped  = [job for job in jobs if (job["xml"], job["seed"]) in finished]
+		jobs     = [job for job in jobs if (job["xml"], job["seed"]) not in finished]
+		if (len(skipped) > 0):
+			sys.stdout.write("Skipping %d jobs that already finished\n" % len(skipped))
+
+	sys.stdout.write("Running %d jobs\n" % len(jobs))
+	failed = runJobs(jobs, inputpath, command=options.command, beast=beast,
+	                 cores=int(options.cores) if options.cores != "" else None,
+	                 memory=int(options.totalmemory) if options.totalmemory != "" else None,
+	                 maxjobs=int(options.jobs), overwrite=options.force, logfile=logfile, interval=float(options.poll))
+
+	sys.stdout.write("%d of %d jobs failed\n" % (failed, len(jobs)))
+
+	end = time.time()
+	sys.stdout.write("Total time taken: "+str(end-start)+" seconds\n")
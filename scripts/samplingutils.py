@@ -0,0 +1,396 @@
+import os, sys, re, time, csv
+import numpy as np
+from optparse import OptionParser
+from dateutils import getDayDoubleDates, getDecimalDays
+
+##############################################################################################
+# Empirical sampling proportions (number of sequences / number of reported cases) on a grid  #
+# of dates (weekly, monthly, equal bins or any change-time grid). Python version of the      #
+# pipeline in workflows/extract_sampling.rmd                                                 #
+##############################################################################################
+
+CASECOLUMNS = ["patient", "patientSum", "situation", "situationSum", "combined", "combinedSum"]
+
+PROPORTIONS = ["patient", "situation", "combined"]
+
+# Case files loaded in this process (path -> (names, days, cases))
+casecache = dict()
+
+
+def readCases(filename):
+    """Read a tab-separated case file (weekly rows named by date) and return a numpy array of days
+    (datetime64[D]) and a (weeks x CASECOLUMNS) array of case counts
+
+    Columns may be prefixed by the region name (e.g. BOFFA.patient).
+
+    """
+
+    with open(filename, "r") as infile:
+        header = [col[col.rfind(".")+1:] for col in infile.readline().split()]
+        rows   = [line.rstrip("\n").split("\t") for line in infile if line.strip() != ""]
+
+    days  = np.array([row[0] for row in rows], dtype="datetime64[D]")
+    table = np.array([row[1:] for row in rows], dtype=float)
+
+    return (days, table[:, [header.index(col) for col in CASECOLUMNS]])
+#
+
+
+def loadCases(survpath):
+    """Read all case files in survpath at once and return the list of names (file names without
+    .csv), the days (shared by all files) and a (files x weeks x CASECOLUMNS) array of case counts
+
+    The result is cached, so every directory is only read once per process.
+
+    """
+
+    survpath = os.path.abspath(survpath)
+    if (survpath not in casecache):
+        names  = sorted(f[:-4] for f in os.listdir(survpath) if f.endswith(".csv"))
+        tables = []
+        for name in names:
+            (filedays, table) = readCases(survpath+"/"+name+".csv")
+            if (len(tables) == 0):
+                days = filedays
+            elif (not np.array_equal(days, filedays)):
+                sys.stdout.write("Warning: %s does not have the same weeks as %s, skipping\n" % (name, names[0]))
+                continue
+            tables.append((name, table))
+
+        casecache[survpath] = ([name for (name, table) in tables], days, np.stack([table for (name, table) in tables]))
+
+    return casecache[survpath]
+#
+
+
+def getCases(survpath, regions):
+    """Return the days and the sum of the case counts for one or more regions (case file names)
+
+    """
+
+    (names, days, cases) = loadCases(survpath)
+    if (isinstance(regions, str)):
+        regions = [regions]
+
+    return (days, cases[[names.index(region) for region in regions]].sum(axis=0))
+#
+
+
+def readSequenceDays(filename, column="date"):
+    """Read the sampling dates of sequences from a csv file (e.g. results/datasets/*.csv) as a
+    numpy array of days (datetime64[D])
+
+    """
+
+    with open(filename, "r") as infile:
+        dates = [row[column] for row in csv.DictReader(infile)]
+
+    return np.array(dates, dtype="datetime64[D]")
+#
+
+
+###########################################################################
+# Grids
+
+def getWeeklyBreaks(days):
+    """Return weekly breaks (Sundays) from the Sunday on or before the first day, until the first
+    break after the last day (as R's hist(..., breaks="weeks", start.on.monday=FALSE))
+
+    """
+
+    # 1970-01-01 was a Thursday, so (day + 4) % 7 is the day of the week with Sunday = 0
+    first = days.min() - ((days.min().astype(np.int64) + 4) % 7)
+    nbins = int((days.max() - first).astype(np.int64) // 7) + 1
+
+    return first + 7*np.arange(0, nbins+1)
+#
+
+
+def getMonthlyBreaks(days):
+    """Return monthly breaks (first of every month) from the month of the first day until the first
+    of the month after the last day
+
+    """
+
+    months = np.arange(days.min().astype("datetime64[M]"), days.max().astype("datetime64[M]") + 2)
+
+    return months.astype("datetime64[D]")
+#
+
+
+def getEqualBreaks(days, nbins=9):
+    """Return nbins+1 breaks (decimal years) equally spaced between the first and last day (as the
+    10 breaks used for the 10bins proportions)
+
+    """
+
+    yeardates = getDayDoubleDates(days)
+
+    return np.linspace(yeardates.min(), yeardates.max(), nbins+1)
+#
+
+
+def getQuantileBreaks(casedays, cases, days, nbins=9, column="combined"):
+    """Return up to nbins+1 breaks (decimal years) between the first and last day, such that each
+    bin has roughly the same number of cases (in column)
+
+    """
+
+    inrange = (casedays >= days.min()) & (casedays <= days.max())
+    counts  = cases[inrange, CASECOLUMNS.index(column)]
+    weeks   = casedays[inrange]
+    if (len(weeks) == 0 or counts.sum() == 0):
+        return getEqualBreaks(days, nbins)
+
+    cumulative = np.cumsum(counts)/counts.sum()
+    inner = weeks[np.minimum(np.searchsorted(cumulative, np.arange(1, nbins)/float(nbins)), len(weeks)-1)]
+
+    return getDayDoubleDates(np.unique(np.concatenate(([days.min()], inner, [days.max()]))))
+#
+
+
+###########################################################################
+# Binning
+
+def binDays(days, breaks, right=False):
+    """Return the bin of every day for the breaks (as R's hist with include.lowest=TRUE)
+
+    With right=False bins are [a, b) and the last bin is [a, b], with right=True bins are (a, b]
+    and the first bin is [a, b]. Days outside the breaks are in bin -1 or len(breaks)-1.
+
+    """
+
+    days   = np.asarray(days, dtype="datetime64[D]")
+    nbins  = len(breaks)-1
+    if (right):
+        bins = np.searchsorted(breaks, days, side="left") - 1
+        bins[days == breaks[0]] = 0
+    else:
+        bins = np.searchsorted(breaks, days, side="right") - 1
+        bins[days == breaks[-1]] = nbins - 1
+
+    bins[(days < breaks[0]) | (days > breaks[-1])] = -1
+
+    return bins
+#
+
+
+def countDays(days, breaks, right=False):
+    """Return the number of days in every bin (as R's hist(..., plot=FALSE)$counts)
+
+    """
+
+    bins = binDays(days, breaks, right)
+
+    return np.bincount(bins[bins >= 0], minlength=len(breaks)-1)
+#
+
+
+def sumCases(casedays, cases, breaks):
+    """Return the sum of the cases in every bin between breaks (decimal years), with rows assigned
+    to bins by the decimal date of their week, [a, b) (as sumBins() in extract_sampling.rmd)
+
+    The cumulative columns (*Sum) are recomputed from the binned counts.
+
+    """
+
+    bins   = np.searchsorted(breaks, getDayDoubleDates(casedays), side="right") - 1
+    inside = (bins >= 0) & (bins < len(breaks)-1)
+    binned = np.zeros((len(breaks)-1, cases.shape[1]))
+    for j in range(0, cases.shape[1]):
+        binned[:,j] = np.bincount(bins[inside], weights=cases[inside,j], minlength=len(breaks)-1)
+
+    for col in PROPORTIONS:
+        binned[:,CASECOLUMNS.index(col+"Sum")] = np.cumsum(binned[:,CASECOLUMNS.index(col)])
+
+    return binned
+#
+
+
+def getProportions(counts, cases, sanitise=True):
+    """Return a dictionary with the proportions (counts / cases) for every column in PROPORTIONS
+
+    If sanitise is True proportions > 1 are set to 1 and 0/0 to 0
+
+    """
+
+    proportions = dict()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for col in PROPORTIONS:
+            proportion = counts/cases[:,CASECOLUMNS.index(col)]
+            if (sanitise):
+                proportion[proportion > 1]       = 1
+                proportion[np.isnan(proportion)] = 0
+            proportions[col] = proportion
+
+    return proportions
+#
+
+
+def getWeeklyProportions(casedays, cases, days, sanitise=True):
+    """Return the days and proportions of sequences to cases every week (cases per week are the
+    rows of the case files, sequences are counted in weeks (a, b])
+
+    """
+
+    breaks = getWeeklyBreaks(days)
+    rows   = np.searchsorted(casedays, breaks[:-1])
+
+    return (breaks[:-1], getProportions(countDays(days, breaks, right=True), cases[rows], sanitise))
+#
+
+
+def getMonthlyProportions(casedays, cases, days, sanitise=True):
+    """Return the days and proportions of sequences to cases every month (weekly cases are summed
+    by the month of their date, sequences are counted in months [a, b))
+
+    """
+
+    breaks = getMonthlyBreaks(days)
+    months = getMonthlyBreaks(casedays)
+
+    return (breaks[:-1], getProportions(countDays(days, breaks), sumCases(casedays, cases, getDayDoubleDates(months))[np.searchsorted(months, breaks[:-1])], sanitise))
+#
+
+
+def getBinnedProportions(casedays, cases, days, breaks, sanitise=True):
+    """Return the days and proportions of sequences to cases in the bins between breaks (decimal
+    years, e.g. sampling rate change times)
+
+    Cases are assigned to bins by the decimal date of their week and sequences are counted in bins
+    [a, b) between the breaks rounded to the nearest day.
+
+    """
+
+    breakdays = getDecimalDays(breaks)
+
+    return (breakdays[:-1], getProportions(countDays(days, breakdays), sumCases(casedays, cases, breaks), sanitise))
+#
+
+
+def isGrid(grid):
+    """Check if a string is the name of a grid (weekly, monthly, <n>bins or <n>quantiles)
+
+    """
+
+    return (re.match(r"^(weekly|monthly|\d+bins|\d+quantiles)$", str(grid).strip()) is not None)
+#
+
+
+def getGridProportions(casedays, cases, days, grid, sanitise=True):
+    """Return the breaks (decimal years), the days of the bins and the proportions for a grid
+    (weekly, monthly, <n>bins, <n>quantiles or an array of breaks in decimal years)
+
+    """
+
+    if (not isinstance(grid, str)):
+        breaks = np.sort(np.asarray(grid, dtype=float))
+        return (breaks,)+getBinnedProportions(casedays, cases, days, breaks, sanitise)
+    elif (grid == "weekly"):
+        breakdays = getWeeklyBreaks(days)
+        return (getDayDoubleDates(breakdays),)+getWeeklyProportions(casedays, cases, days, sanitise)
+    elif (grid == "monthly"):
+        breakdays = getMonthlyBreaks(days)
+        return (getDayDoubleDates(breakdays),)+getMonthlyProportions(casedays, cases, days, sanitise)
+    elif (grid.endswith("quantiles")):
+        breaks = getQuantileBreaks(casedays, cases, days, int(grid[:-len("quantiles")])-1)
+    elif (grid.endswith("bins")):
+        breaks = getEqualBreaks(days, int(grid[:-len("bins")])-1)
+    else:
+        raise ValueError("Unknown grid %s" % grid)
+
+    return (breaks,)+getBinnedProportions(casedays, cases, days, breaks, sanitise)
+#
+
+
+def formatNumber(x):
+    """Format a number as R's write.csv (15 significant digits)
+
+    """
+
+    return ("%.15g" % x)
+#
+
+
+def writeProportions(filename, days, proportions):
+    """Write proportions to a csv file in the same (transposed) format as extract_sampling.rmd:
+    one column per date with rows yeardate, patient, situation and combined
+
+    """
+
+    with open(filename, "w") as outfile:
+        outfile.write(","+",".join(str(day) for day in days)+"\n")
+        outfile.write("yeardate,"+",".join(map(formatNumber, getDayDoubleDates(days)))+"\n")
+        for col in PROPORTIONS:
+            outfile.write(col+","+",".join(map(formatNumber, proportions[col]))+"\n")
+#
+
+
+##############################################################################################
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog [option]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-c","--cases",
+                      dest = "cases",
+                      default = "../data/cases/",
+                      metavar = "path",
+                      help = "Path to directory with case files [default: %default]")
+
+    parser.add_option("-r","--regions",
+                      dest = "regions",
+                      default = "guinea_cases,liberia_cases,sierraleone_cases",
+                      metavar = "string",
+                      help = "Comma separated list of case files (without .csv) to sum [default: %default]")
+
+    parser.add_option("-i","--inputfile",
+                      dest = "inputfile",
+                      default = "",
+                      metavar = "path",
+                      help = "Csv file with sequence dates (date column) [required]")
+
+    parser.add_option("-o","--outputpath",
+                      dest = "outputpath",
+                      default = "../results/datasets/proportions/",
+                      metavar = "path",
+                      help = "Path to save output files in [default: %default]")
+
+    parser.add_option("-p","--prefix",
+                      dest = "prefix",
+                      default = "",
+                      metavar = "string",
+                      help = "Prefix for the output files [required]")
+
+    parser.add_option("-g","--grid",
+                      dest = "grid",
+                      default = "weekly,monthly,10bins",
+                      metavar = "string",
+                      help = "Comma separated list of grids: weekly, monthly, <n>bins (n equally spaced breaks), <n>quantiles (n breaks with equal cases) or @<file> with one change time per line (decimal years) [default: %default]")
+
+    (options,args) = parser.parse_args()
+
+    outputpath = os.path.abspath(options.outputpath)+"/"
+    if (not os.path.exists(outputpath)):
+        os.makedirs(outputpath)
+
+    start = time.time()
+
+    (casedays, cases) = getCases(options.cases, options.regions.split(","))
+    days = readSequenceDays(options.inputfile)
+
+    for grid in options.grid.split(","):
+        if (grid.startswith("@")):
+            (breaks, bindays, proportions) = getGridProportions(casedays, cases, days, np.loadtxt(grid[1:], ndmin=1))
+        elif (isGrid(grid)):
+            (breaks, bindays, proportions) = getGridProportions(casedays, cases, days, grid)
+        else:
+            sys.stdout.write("Unknown grid %s\n" % grid)
+            continue
+
+        writeProportions(outputpath+options.prefix+"-"+grid.lstrip("@").replace("/","_")+".csv", bindays, proportions)
+        sys.stdout.write("%s: %d bins\n" % (grid, len(bindays)))
+
+    end = time.time()
+    sys.stdout.write("Total time taken: "+str(end-start)+" seconds\n")
@@ -1,15 +1,17 @@
-import os, sys, time
+import os, sys, time, re
 import yaml
 import numpy as np
 
-from fnmatch       import fnmatch
+from fnmatch       import fnmatch, translate
+from itertools     import compress
 from datetime      import datetime
 from optparse      import OptionParser
 from Bio           import SeqIO, Seq, AlignIO
 from Bio.SeqRecord import SeqRecord
 
-from dateutils import getDoubleDate
-from fileutils import parseList, getMapping
+from dateutils import getDoubleDate, getDoubleDates
+from fileutils import parseList, getMapping, readMetadataColumns
+from alignutils import readMSA, getSequenceLookup, writeFastaRecord, loadSequenceStats
 
 
 ###########################################################################################################
@@ -21,6 +23,10 @@ from fileutils import parseList, getMapping
 #   - Selection criteria can be passed as either input arguments or a yaml configuration file
 #   - Input arguments supersede the yaml configuration file
 #
+# The alignment is indexed instead of parsed (the index is saved next to the alignment as .fai and
+# reused) and only the sequences that are needed are read from the alignment. With -w (stream) 
+# every matching sequence is written to the output as soon as its metadata row has been evaluated.
+#
 # THIS IS TO SELECT SEQUENCES THAT FULFILL CERTAIN CRITERIA, NOT TO SUBSAMPLE THEM!
 #
 # Select genomes by:
@@ -31,6 +37,16 @@ from fileutils import parseList, getMapping
 #   -C, --country    : Country                           (comma-separated list)
 #   -P, --province   : Province                          (comma-separated list)
 #   -L, --length     : Minimum ungapped sequence length  (integer)
+#   -N, --maxn       : Maximum proportion of N's         (float)
+#
+# The selection criteria are compiled once into a list of predicates, ordered from cheapest to most 
+# expensive, and evaluation of a row stops at the first criterion it fails.
+#
+# With -T (columnar) the metadata is loaded into columns (quoted fields are parsed properly) and every 
+# criterion is evaluated as a boolean mask over whole columns at once.
+#
+# Sequence lengths and N counts are taken from a table of per-sequence statistics that is computed 
+# once and saved next to the alignment (.stats.csv)
 #
 #
 # Ignored metadata (perhaps added in the future)
@@ -59,7 +75,7 @@ parser.add_option("-a","--alignfile",
                   dest = "alignfile",
                   default = "",
                   metavar = "path",
-                  help = "Path to input alignment file [optional]")
+                  help = "Path to input alignment file (fasta or packed) [optional]")
 
 parser.add_option("-o","--outputpath",
                   dest = "outputpath",
@@ -103,6 +119,18 @@ parser.add_option("-u","--updateids",
                   action = "store_true",
                   help = "Update sequence ids [default: %default] [optional]")
 
+parser.add_option("-w","--stream",
+                  dest = "stream",
+                  default = False,
+                  action = "store_true",
+                  help = "Write each matching sequence as soon as it is found [default: %default] [optional]")
+
+parser.add_option("-T","--columnar",
+                  dest = "columnar",
+                  default = False,
+                  action = "store_true",
+                  help = "Load the metadata into columns and evaluate all criteria on whole columns at once [default: %default] [optional]")
+
 parser.add_option("-s","--seqidformat",
                   dest = "seqidformat",
                   default = "EBOV|{id}|{accession}|{country}|{province}|{date}",
@@ -148,6 +176,12 @@ parser.add_option("-L","--length",
                   metavar = "integer",
                   help = "Minimum length of sequences to select (ungapped, inclusive, use alignment if possible) [optional]")
 
+parser.add_option("-N","--maxn",
+                  dest = "maxn",
+                  default = "",
+                  metavar = "float",
+                  help = "Maximum proportion of N's in the aligned sequence (inclusive, requires alignment) [optional]")
+
 (options,args) = parser.parse_args()
 
 inputfile  = os.path.abspath(options.inputfile)
@@ -159,6 +193,8 @@ fasep      = options.fasep
 msaonly    = options.msaonly
 updateids  = options.updateids
 seqidformat= options.seqidformat
+stream     = options.stream
+columnar   = options.columnar
 
 ###########################
 
@@ -171,6 +207,7 @@ inputpars["daterange"] = options.daterange
 inputpars["country"]    = options.country
 inputpars["province"]  = options.province
 inputpars["length"]    = options.length
+inputpars["maxn"]      = options.maxn
 
 
 
@@ -218,9 +255,7 @@ def readAlignment(inputfile, fmt, sep="|"):
 
       """
 
-      alignfile = open(inputfile,"r")
-      alignment = AlignIO.read(alignfile,fmt)
-      alignfile.close()
+      alignment = readMSA(inputfile, fmt)
 
       seqdict = dict()
       for seqrecord in alignment:
@@ -233,6 +268,24 @@ def readAlignment(inputfile, fmt, sep="|"):
 #
 
 
+def indexAlignment(inputfile, sep="|"):
+      """Index alignment and return a dictionary mapping the id field of each sequence to its 
+         full id and a function to read a sequence from the alignment by its full id
+
+      """
+
+      (ids, lookup) = getSequenceLookup(inputfile)
+
+      seqdict = dict()
+      for fullid in ids:
+          idx   = fullid.find(sep)
+          seqid = fullid[idx+1:fullid.find(sep, idx+1)]
+          seqdict[seqid] = fullid
+
+      return (seqdict, lookup)
+#
+
+
 def fuzzyStringMatch(candidate, matchlist):
     """Equivalent to (candidate in matchlist) but with fnmatch for wildcards in the list
 
@@ -242,6 +295,141 @@ def fuzzyStringMatch(candidate, matchlist):
 #
 
 
+def compileStringMatch(matchlist):
+    """Return a function equivalent to fuzzyStringMatch(candidate, matchlist), with exact strings
+       in a set and all wildcard patterns combined into a single pre-compiled regular expression
+
+    """
+
+    exact    = set([x for x in matchlist if not re.search(r"[\*\?\[]", x)])
+    wildcard = [x for x in matchlist if x not in exact]
+
+    if (len(wildcard) == 0):
+        return (lambda candidate : candidate in exact)
+
+    regex = re.compile("|".join(["(?:%s)" % translate(x) for x in wildcard])).match
+    return (lambda candidate : candidate in exact or regex(candidate) is not None)
+#
+
+
+def compileSelection(selection, mapping, msaids=None, msastats=None):
+    """Compile the selection criteria into a list of (criterion, predicate) tuples, where each
+       predicate takes a metadata row and returns True if the row passes the criterion
+
+       Predicates are ordered with the cheapest checks first
+    """
+
+    predicates = []
+    for par in selection:
+
+        # ID in excludes/includes
+        if (par == "exclude" or par == "include"):
+            ids   = set(selection[par])
+            idcol = mapping["id"]
+            if (par == "exclude"):
+                predicate = (lambda ids, idcol : lambda row : row[idcol] not in ids)(ids, idcol)
+            else:
+                predicate = (lambda ids, idcol : lambda row : row[idcol] in ids)(ids, idcol)
+            cost = 0
+
+        # Date range
+        elif (par == "daterange"):
+            (lower, upper) = selection[par]
+            datecol = mapping["date"]
+
+            def predicate(row, lower=lower, upper=upper, datecol=datecol):
+                try:
+                    date = getDoubleDate(datetime.strptime(row[datecol], "%Y-%m-%d"))
+                except:
+                    return False
+                return (date >= lower and date < upper)
+            cost = 3
+
+        # Length and proportion of N's
+        elif (par == "length" or par == "maxn"):
+            if (msastats is None):
+                sys.stdout.write("ERROR! No alignment file specified, cannot select by %s\n" % par)
+                raise RuntimeError
+
+            idcol = mapping["id"]
+            if (par == "length"):
+                predicate = (lambda stats, minlen, idcol : lambda row : stats["ungapped"][msaids[row[idcol]]] >= minlen)(msastats, selection[par], idcol)
+            else:
+                predicate = (lambda stats, maxn, idcol : lambda row : stats["N"][msaids[row[idcol]]] <= maxn*stats["length"][msaids[row[idcol]]])(msastats, selection[par], idcol)
+            cost = 2
+
+        # Other comma-separated fields
+        else:
+            match = compileStringMatch(selection[par])
+            col   = mapping[par]
+            predicate = (lambda match, col : lambda row : row[col] != 'NA' and match(row[col]))(match, col)
+            cost = 1
+
+        predicates.append((cost, par, predicate))
+
+    return [(par, predicate) for (cost, par, predicate) in sorted(predicates, key=lambda x : x[0])]
+#
+
+
+def getColumnMask(column, match):
+    """Return a boolean mask of the values in a column for which match(value) is True, calling
+       match only once for every distinct value
+
+    """
+
+    distinct = dict([(value, match(value)) for value in set(column)])
+
+    return np.fromiter((distinct[value] for value in column), dtype=bool, count=len(column))
+#
+
+
+def getSelectionMask(selection, mapping, columns, msaids=None, msastats=None):
+    """Evaluate the selection criteria on whole metadata columns at once and return a boolean 
+       mask of the rows that pass all criteria
+
+    """
+
+    nrows = len(columns[0]) if len(columns) > 0 else 0
+    mask  = np.ones(nrows, dtype=bool)
+    for par in selection:
+
+        # ID in excludes/includes
+        if (par == "exclude"):
+            ids   = set(selection[par])
+            mask &= ~getColumnMask(columns[mapping["id"]], lambda value : value in ids)
+
+        elif (par == "include"):
+            ids   = set(selection[par])
+            mask &= getColumnMask(columns[mapping["id"]], lambda value : value in ids)
+
+        # Date range
+        elif (par == "daterange"):
+            dates = getDoubleDates(columns[mapping["date"]])
+            with np.errstate(invalid="ignore"):
+                mask &= (dates >= selection[par][0]) & (dates < selection[par][1])
+
+        # Length and proportion of N's
+        elif (par == "length" or par == "maxn"):
+            if (msastats is None):
+                sys.stdout.write("ERROR! No alignment file specified, cannot select by %s\n" % par)
+                raise RuntimeError
+
+            fullids = [msaids[seqid] for seqid in columns[mapping["id"]]]
+            getStat = lambda col : np.array([msastats[col][fullid] for fullid in fullids], dtype=np.int64)
+            if (par == "length"):
+                mask &= (getStat("ungapped") >= selection[par])
+            else:
+                mask &= (getStat("N") <= selection[par]*getStat("length"))
+
+        # Other comma-separated fields (match every distinct value only once)
+        else:
+            match = compileStringMatch(selection[par])
+            mask &= getColumnMask(columns[mapping[par]], lambda value : value != 'NA' and match(value))
+
+    return mask
+#
+
+
 def getSequenceFields(datalist, mapping):
     """Return dictionary with fields of the datalist mapped with the mapping
 
@@ -325,15 +513,24 @@ for par in configpars:
         elif (par == "length"):
             selection[par] = int(configpars[par])
 
+        elif (par == "maxn"):
+            selection[par] = float(configpars[par])
+
         else:
             selection[par] = parseList(configpars[par])
 
 printCriteria(selection)
 
 
-# Read alignment
+# Index alignment
 if (alignfile != ""):
-     msaseqs = readAlignment(alignfile, "fasta")
+     (msaids, msalookup) = indexAlignment(alignfile, sep=fasep)
+     msafile = None
+
+     # Per-sequence statistics
+     if ("length" in selection or "maxn" in selection):
+          msastats = loadSequenceStats(alignfile)
+          msastats = dict([(col, dict(zip(msastats["id"], msastats[col]))) for col in msastats if col != "id"])
 
 # Make output folder
 if (not os.path.exists(outputpath)):
@@ -342,123 +539,147 @@ if (not os.path.exists(outputpath)):
 evaluated = 0
 matched   = 0
 skipped   = 0
+extracted = 0
 sequences = []
 
-db        = open(inputfile,'r')
-header    = db.readline().strip().split(dbsep)
-mapping   = getMapping(header, fieldmapping)
 
+def saveSequence(row, seqid):
+    """Extract the sequence for a matching metadata row from the alignment and either write it 
+       straight to the output alignment (stream) or keep it to write at the end
 
-if (prefix == ""):
-    prefix = inputfile[inputfile.rfind('/')+1:inputfile.rfind('.')]
+    """
 
-if (msaonly != True):
-    outputdb  = open(outputpath+prefix+".csv", "w")
-    skipfile  = open(outputpath+prefix+".skipped.csv","w")
-    outputdb.write(dbsep.join(header)+"\n")
-    skipfile.write(dbsep.join(header)+"\n")
-
-for line in db:
-    evaluated += 1
-    row = line.strip().split(dbsep)
-    seqid = row[mapping["id"]]
-    
-    ##################################################
-    # Check selection criteria
-    skip  = False
-    extra = False
-    for par in selection.keys():
-        #sys.stdout.write("%s\t%s\t%s\n" % (par, row[mapping[par]], str(selection[par])))
-    
-        # ID in excludes
-        if (par == "exclude"):
-            #if (fuzzyStringMatch(row[mapping["id"]], selection[par]) == True):
-            if (row[mapping["id"]] in selection[par]):
-                skip = True
-                continue
+    global msafile, extracted
 
-        # ID in includes
-        elif (par == "include"):
-            #if (fuzzyStringMatch(row[mapping["id"]], selection[par]) == False):
-            if (row[mapping["id"]] not in selection[par]):
-                skip = True
-                continue
+    # Write sequence straight to the output alignment
+    if (stream):
+        if (seqid not in msaids):
+            sys.stdout.write("Warning: %s not found in alignment\n" % seqid)
+            return
 
-        # Date range
-        elif (par == "daterange"):
-            try: 
-                date = getDoubleDate(datetime.strptime(row[mapping["date"]], "%Y-%m-%d"))
+        if (updateids):
+            newid = seqidformat.format(**getSequenceFields(row, mapping))
+        else:
+            newid = msaids[seqid]
 
-                if (date < selection["daterange"][0] or date >= selection["daterange"][1]):
-                    raise ValueError()
-            except: 
-                skip = True
-                continue
-        
-        # Length
-        elif (par == 'length'):
+        if (msafile is None):
+            msafile = open(outputpath+prefix+".fas", "wb")
+        writeFastaRecord(msafile, newid, msalookup(msaids[seqid]))
+        extracted += 1
 
-            if (alignfile != ""):
-                seq = msaseqs[seqid].seq.ungap("-").ungap("N") 
-            else:
-                sys.stdout.write("ERROR! No alignment file specified, cannot select by sequence length\n")
-                raise RuntimeError
-           
+    # Save alignment
+    else:
+        seq = SeqRecord(Seq.Seq(msalookup(msaids[seqid]).decode()), id=msaids[seqid], description="")
+
+        # Update sequence ids
+        if (updateids):
+            seqdict = getSequenceFields(row, mapping)
+            newid   = seqidformat.format(**seqdict)
+            seq.id  = newid
+            seq.description = ""
+        sequences.append(seq)
+#
 
-            if (len(seq) < selection["length"]):
-                skip = True
-                continue
 
-        # Other comma-separated fields
-        else:
+if (prefix == ""):
+    prefix = inputfile[inputfile.rfind('/')+1:inputfile.rfind('.')]
 
-            if (row[mapping[par]] == 'NA' or fuzzyStringMatch(row[mapping[par]], selection[par]) == False):
-                skip = True
-                continue
+if (columnar):
 
-            #if (selection[par] != [] and row[mapping[par]] not in selection[par]):
-            #    skip = True
-            #    continue
+    ##################################################
+    # Evaluate all criteria on whole columns
+    (header, lines, columns) = readMetadataColumns(inputfile, sep=dbsep)
+    mapping = getMapping(header, fieldmapping)
+
+    mask = getSelectionMask(selection, mapping, columns, 
+                            msaids   = msaids   if alignfile != "" else None, 
+                            msastats = msastats if alignfile != "" and ("length" in selection or "maxn" in selection) else None)
+
+    evaluated = len(mask)
+    matched   = int(np.count_nonzero(mask))
+    skipped   = evaluated - matched
+
+    # Write metadata in bulk
+    if (msaonly != True):
+        with open(outputpath+prefix+".csv", "w") as outputdb:
+            outputdb.write(dbsep.join(header)+"\n")
+            outputdb.write("".join([line+"\n" for line in compress(lines, mask)]))
+        with open(outputpath+prefix+".skipped.csv","w") as skipfile:
+            skipfile.write(dbsep.join(header)+"\n")
+            skipfile.write("".join([line+"\n" for line in compress(lines, ~mask)]))
+
+    # Extract sequences
+    if (alignfile != ""):
+        for i in np.flatnonzero(mask):
+            saveSequence([column[i] for column in columns], columns[mapping["id"]][i])
 
-    # Sequence is in extra list and is always included
-    if (extra):
-        skip = False
+else:
 
-    ##################################################
-    # Skip or save
-    if (skip):
-        if (msaonly == False):
-            skipfile.write(dbsep.join(row)+"\n")
-        skipped += 1
-    else:
-        matched += 1
+    db        = open(inputfile,'r')
+    header    = db.readline().strip().split(dbsep)
+    mapping   = getMapping(header, fieldmapping)
+
+    predicates = compileSelection(selection, mapping, 
+                                  msaids   = msaids   if alignfile != "" else None, 
+                                  msastats = msastats if alignfile != "" and ("length" in selection or "maxn" in selection) else None)
 
-        # Save metadata
-        if (msaonly != True):
-            outputdb.write(dbsep.join(row)+"\n")
+    if (msaonly != True):
+        outputdb  = open(outputpath+prefix+".csv", "w")
+        skipfile  = open(outputpath+prefix+".skipped.csv","w")
+        outputdb.write(dbsep.join(header)+"\n")
+        skipfile.write(dbsep.join(header)+"\n")
 
-        # Save alignment
-        if (alignfile != ""):            
-            seq = msaseqs[seqid]
+    for line in db:
+        evaluated += 1
+        row = line.strip().split(dbsep)
+        seqid = row[mapping["id"]]
+        
+        ##################################################
+        # Check selection criteria (stop at the first criterion that fails)
+        skip  = False
+        extra = False
+        for (par, predicate) in predicates:
+            if (not predicate(row)):
+                skip = True
+                break
+
+        # Sequence is in extra list and is always included
+        if (extra):
+            skip = False
+
+        ##################################################
+        # Skip or save
+        if (skip):
+            if (msaonly == False):
+                skipfile.write(dbsep.join(row)+"\n")
+            skipped += 1
+        else:
+            matched += 1
 
-            # Update sequence ids
-            if (updateids):
-                seqdict = getSequenceFields(row, mapping)
-                newid   = seqidformat.format(**seqdict)
-                seq.id  = newid
-                seq.description = ""
-            sequences.append(seq)
+            # Save metadata
+            if (msaonly != True):
+                outputdb.write(dbsep.join(row)+"\n")
 
+            # Save sequence
+            if (alignfile != ""):
+                saveSequence(row, seqid)
 
-db.close()
+    db.close()
 
-if (msaonly != True):
-    outputdb.close()
-    skipfile.close()
+    if (msaonly != True):
+        outputdb.close()
+        skipfile.close()
 
 # Write sequence file
 if (len(sequences) > 0):
     SeqIO.write(sequences,outputpath+prefix+".fas","fasta")
+    extracted = len(sequences)
+
+if (alignfile != "" and stream and msafile is not None):
+    msafile.close()
+
+if (alignfile != ""):
+    msalookup.close()
 
 
 # Print some statistics
@@ -466,7 +687,7 @@ sys.stdout.write("\nRESULTS SUMMARY\n")
 sys.stdout.write("%10d sequence(s) evaluated\n" % evaluated)
 sys.stdout.write("%10d matching sequences found\n" % matched)
 sys.stdout.write("%10d sequences skipped\n" % skipped)
-sys.stdout.write("%10d matching sequences extracted from alignment\n\n" % len(sequences))
+sys.stdout.write("%10d matching sequences extracted from alignment\n\n" % extracted)
 
 
 end = time.time()
@@ -0,0 +1,350 @@
+import os, sys, time, csv
+import multiprocessing
+import numpy as np
+from itertools import compress
+from optparse import OptionParser
+from fileutils import parseList, getMapping, readMetadataColumns
+from alignutils import getSequenceLookup, writeFastaRecord
+from samplingutils import getWeeklyBreaks, getMonthlyBreaks, binDays
+
+
+# Stratified subsampling of sequences from a metadata csv file (and alignment)
+################################################################################################################################
+#
+# - Sequences are stratified by any combination of time bin (week, month or year of the sampling date)
+#   and metadata columns (e.g. country, location)
+# - From every stratum ceil(fraction x sequences) sequences are sampled without replacement, but strata
+#   where this is less than the minimum are kept whole (the same rule as downsampleStratifiedByMonth() in
+#   workflows/extract_datasets.rmd, but time bins are calendar weeks/months [first day, next first day),
+#   while the R code bins with right-closed hist() breaks, so sizes per month can differ slightly)
+# - Fractions and minimums can be set per stratum in a csv file with some of the strata as columns
+#   ("*" matches all values) and fraction and/or minimum columns (the last matching row is used)
+# - All strata are sampled at once: every sequence gets a random key and the sequences with the
+#   smallest keys in every stratum are selected
+# - Replicates use consecutive seeds (seed, seed+1, ...) and are written in parallel (-j)
+#
+# THIS IS TO SUBSAMPLE SEQUENCES, USE selectsequences.py TO SELECT SEQUENCES THAT FULFILL CERTAIN CRITERIA
+#
+################################################################################################################################
+
+TIMESTRATA = ["week", "month", "year"]
+
+# Column mapping
+fieldmapping = {"id"   : "sample_id",
+                "date" : "date"}
+
+# Metadata and alignment shared with the worker processes
+shared = dict()
+
+
+def getTimeStrata(dates, stratum="month"):
+    """Return the time bin (first day of the bin as a string) of every date (weeks start on Sunday).
+    Bins are calendar bins, from the first day up to the first day of the next bin. Missing dates
+    are in bin "NA"
+
+    """
+
+    days  = np.array([date if date != "NA" else "NaT" for date in dates], dtype="datetime64[D]")
+    valid = ~np.isnat(days)
+    bins  = np.full(len(days), "NA", dtype=object)
+    if (not valid.any()):
+        return bins
+
+    if (stratum == "year"):
+        bins[valid] = days[valid].astype("datetime64[Y]").astype("datetime64[D]").astype(str)
+    else:
+        breaks = getWeeklyBreaks(days[valid]) if stratum == "week" else getMonthlyBreaks(days[valid])
+        bins[valid] = breaks[binDays(days[valid], breaks)].astype(str)
+
+    return bins
+#
+
+
+def getStrata(header, columns, strata, mapping):
+    """Return the values of every stratum (a list of tuples) and the stratum index of every row
+
+    """
+
+    values = []
+    for stratum in strata:
+        if (stratum in TIMESTRATA):
+            values.append(getTimeStrata(columns[mapping["date"]], stratum))
+        elif (stratum in header):
+            values.append(np.array(columns[header.index(stratum)], dtype=object))
+        else:
+            sys.stdout.write("ERROR! Stratum %s is not a time bin (%s) or a column in the metadata\n" % (stratum, ", ".join(TIMESTRATA)))
+            raise RuntimeError
+
+    # Combine strata into one key per row
+    keys = np.array(["\t".join(key) for key in zip(*values)] if len(values) > 0 else [""]*len(columns[0]), dtype=object)
+    (names, index) = np.unique(keys, return_inverse=True)
+
+    return ([tuple(name.split("\t")) if len(strata) > 0 else () for name in names], index)
+#
+
+
+def readFractions(fractionfile, strata, fraction=0.2, minimum=5):
+    """Read per-stratum fractions and minimums from a csv file and return a function that returns
+    the (fraction, minimum) for the values of a stratum
+
+    The file has some of the strata as columns ("*" matches all values) and fraction and/or minimum
+    columns. Values not in the file use the default fraction and minimum.
+
+    """
+
+    rules = []
+    if (fractionfile != ""):
+        with open(fractionfile, "r") as infile:
+            reader  = csv.DictReader(infile)
+            unknown = [col for col in reader.fieldnames if col not in strata and col not in ["fraction", "minimum"]]
+            if (len(unknown) > 0):
+                sys.stdout.write("ERROR! Columns in %s are not strata (%s) or fraction/minimum: %s\n" % (fractionfile, ", ".join(strata), ", ".join(unknown)))
+                raise RuntimeError
+
+            for row in reader:
+                match = [(strata.index(col), value) for (col, value) in row.items() if col in strata and value != "*"]
+                rules.append((match, float(row["fraction"]) if row.get("fraction", "") != "" else None,
+                                     int(row["minimum"])    if row.get("minimum", "")  != "" else None))
+
+    def getFraction(values):
+        (f, m) = (fraction, minimum)
+        for (match, rulefraction, ruleminimum) in rules:
+            if (all(values[i] == value for (i, value) in match)):
+                f = f if rulefraction is None else rulefraction
+                m = m if ruleminimum  is None else ruleminimum
+        return (f, m)
+
+    return getFraction
+#
+
+
+def getSampleSizes(counts, fractions, minimums):
+    """Return the number of sequences to sample from every stratum: ceil(fraction x count), or all
+    sequences in the stratum if this is less than the minimum
+
+    """
+
+    sizes = np.ceil(fractions*counts).astype(np.int64)
+
+    return np.where(sizes < minimums, counts, np.minimum(sizes, counts))
+#
+
+
+def subsample(index, sizes, seed):
+    """Return a boolean mask of the rows selected from every stratum (index gives the stratum of
+    every row and sizes the number of rows to sample from every stratum)
+
+    Every row gets a random key and the rows with the smallest keys in every stratum are selected,
+    so all strata are sampled in one pass.
+
+    """
+
+    keys  = np.random.RandomState(seed).random_sample(len(index))
+    order = np.lexsort((keys, index))
+    first = np.searchsorted(index[order], np.arange(0, len(sizes)))
+    rank  = np.arange(0, len(index)) - first[index[order]]
+
+    mask = np.zeros(len(index), dtype=bool)
+    mask[order[rank < sizes[index[order]]]] = True
+
+    return mask
+#
+
+
+def getAlignmentIds(alignfile, sep="|"):
+    """Return a dictionary mapping the id field of every sequence in the alignment to its full id
+    and a function to read a sequence by its full id
+
+    """
+
+    (ids, lookup) = getSequenceLookup(alignfile)
+
+    return (dict((fullid.split(sep)[1] if sep in fullid else fullid, fullid) for fullid in ids), lookup)
+#
+
+
+def setShared(data):
+    """Set the metadata, strata and alignment used by writeReplicate (initializer of the worker
+    processes, so the alignment is only opened once per process). The alignment ids (msaids) are
+    read in the main process, so a bad alignment fails before any workers are started
+
+    """
+
+    shared.update(data)
+    if (data["alignfile"] != ""):
+        shared["lookup"] = getSequenceLookup(data["alignfile"])[1]
+#
+
+
+def writeReplicate(seed, name):
+    """Subsample with a seed and write the metadata (and sequences) of the selected rows to
+    name.csv (and name.fas). Return the seed and the number of selected sequences
+
+    """
+
+    mask = subsample(shared["index"], shared["sizes"], seed)
+
+    with open(name+".csv", "w") as outfile:
+        outfile.write(shared["header"]+"\n")
+        outfile.write("".join([line+"\n" for line in compress(shared["lines"], mask)]))
+
+    if (shared["alignfile"] != ""):
+        (msaids, lookup) = (shared["msaids"], shared["lookup"])
+        missing = 0
+        with open(name+".fas", "wb") as outfile:
+            for seqid in compress(shared["ids"], mask):
+                if (seqid not in msaids):
+                    missing += 1
+                    continue
+                writeFastaRecord(outfile, msaids[seqid], lookup(msaids[seqid]))
+
+        if (missing > 0):
+            sys.stdout.write("Warning: %d selected sequences not found in alignment (seed %d)\n" % (missing, seed))
+
+    return (seed, int(np.count_nonzero(mask)))
+#
+
+
+################################################################################################################################
+
+if __name__ == "__main__":
+
+    ################################################################################################################################
+    # Parameters
+
+    usage = "usage: %prog [option]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-i","--inputfile",
+                      dest = "inputfile",
+                      default = "",
+                      metavar = "path",
+                      help = "Path to input csv file [required]")
+
+    parser.add_option("-a","--alignfile",
+                      dest = "alignfile",
+                      default = "",
+                      metavar = "path",
+                      help = "Path to input alignment file (fasta or packed) to extract the subsampled sequences from [optional]")
+
+    parser.add_option("-o","--outputpath",
+                      dest = "outputpath",
+                      default = "",
+                      metavar = "path",
+                      help = "Path to save output files in [required]")
+
+    parser.add_option("-p","--prefix",
+                      dest = "prefix",
+                      default = "",
+                      metavar = "string",
+                      help = "Prefix for the output files [default: input file name]")
+
+    parser.add_option("-S","--strata",
+                      dest = "strata",
+                      default = "month",
+                      metavar = "comma-separated list of strings",
+                      help = "Strata: time bins (week, month, year) and/or metadata columns (e.g. month,country,location) [default: %default]")
+
+    parser.add_option("-f","--fraction",
+                      dest = "fraction",
+                      default = "0.2",
+                      metavar = "float",
+                      help = "Fraction of sequences to sample from every stratum [default: %default]")
+
+    parser.add_option("-m","--minimum",
+                      dest = "minimum",
+                      default = "5",
+                      metavar = "integer",
+                      help = "Strata where fewer sequences than this would be sampled are kept whole [default: %default]")
+
+    parser.add_option("-F","--fractions",
+                      dest = "fractions",
+                      default = "",
+                      metavar = "path",
+                      help = "Csv file with per-stratum fractions and minimums (strata as columns, * for all values, and fraction and/or minimum columns) [optional]")
+
+    parser.add_option("-s","--seed",
+                      dest = "seed",
+                      default = "127",
+                      metavar = "integer",
+                      help = "Seed or comma-separated list of seeds (one replicate per seed) [default: %default]")
+
+    parser.add_option("-r","--replicates",
+                      dest = "replicates",
+                      default = "1",
+                      metavar = "integer",
+                      help = "Number of replicates (with consecutive seeds from the first seed, if only one seed is given) [default: %default]")
+
+    parser.add_option("-j","--jobs",
+                      dest = "jobs",
+                      default = "1",
+                      metavar = "integer",
+                      help = "Number of replicates to write in parallel [default: %default]")
+
+    parser.add_option("-d","--dbsep",
+                      dest = "dbsep",
+                      default = ",",
+                      metavar = "string",
+                      help = "Separator between columns in the csv file [default: %default]")
+
+    (options,args) = parser.parse_args()
+
+    inputfile  = os.path.abspath(options.inputfile)
+    alignfile  = os.path.abspath(options.alignfile) if options.alignfile != "" else ""
+    outputpath = os.path.abspath(options.outputpath)+"/"
+    prefix     = options.prefix if options.prefix != "" else inputfile[inputfile.rfind('/')+1:inputfile.rfind('.')]
+    strata     = parseList(options.strata)
+    seeds      = parseList(options.seed, int)
+    jobs       = int(options.jobs)
+    if (len(seeds) == 1):
+        seeds = list(range(seeds[0], seeds[0]+int(options.replicates)))
+
+
+    ################################################################################################################################
+    start = time.time()
+
+    if (not os.path.exists(outputpath)):
+        os.makedirs(outputpath)
+
+    # Strata and sample sizes (the same for all replicates)
+    (header, lines, columns) = readMetadataColumns(inputfile, sep=options.dbsep)
+    mapping = getMapping(header, fieldmapping)
+    (names, index) = getStrata(header, columns, strata, mapping)
+
+    getFraction = readFractions(options.fractions, strata, float(options.fraction), int(options.minimum))
+    counts    = np.bincount(index, minlength=len(names))
+    fractions = np.array([getFraction(name)[0] for name in names])
+    minimums  = np.array([getFraction(name)[1] for name in names])
+    sizes     = getSampleSizes(counts, fractions, minimums)
+
+    with open(outputpath+prefix+".strata.csv", "w") as outfile:
+        outfile.write(",".join(strata+["sequences", "fraction", "minimum", "sampled"])+"\n")
+        for i in range(0, len(names)):
+            outfile.write(",".join(list(names[i])+[str(counts[i]), str(fractions[i]), str(minimums[i]), str(sizes[i])])+"\n")
+
+    sys.stdout.write("%d sequences in %d strata (%s), sampling %d sequences per replicate\n" % (len(index), len(names), ", ".join(strata), sizes.sum()))
+
+    # Replicates (the alignment is indexed here, before starting any workers)
+    data = {"header" : options.dbsep.join(header), "lines" : lines, "ids" : columns[mapping["id"]],
+            "index" : index, "sizes" : sizes, "alignfile" : alignfile}
+    if (alignfile != ""):
+        (data["msaids"], lookup) = getAlignmentIds(alignfile)
+        lookup.close()
+    outnames = [outputpath+prefix if len(seeds) == 1 else "%s%s_%d" % (outputpath, prefix, seed) for seed in seeds]
+
+    if (jobs > 1 and len(seeds) > 1):
+        pool = multiprocessing.Pool(min(jobs, len(seeds)), initializer=setShared, initargs=(data,))
+        results = pool.starmap(writeReplicate, zip(seeds, outnames))
+        pool.close()
+        pool.join()
+    else:
+        setShared(data)
+        results = [writeReplicate(seed, name) for (seed, name) in zip(seeds, outnames)]
+        if (alignfile != ""):
+            shared["lookup"].close()
+
+    for (seed, selected) in results:
+        sys.stdout.write("Seed %d: %d sequences selected\n" % (seed, selected))
+
+    end = time.time()
+    sys.stdout.write("Total time taken: "+str(end-start)+" seconds\n")
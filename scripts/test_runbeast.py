@@ -0,0 +1,104 @@
+import os, sys, csv, subprocess
+
+
+# Tests for runbeast.py with a stub command instead of BEAST (run with python -m pytest test_runbeast.py)
+################################################################################################################################
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runbeast.py")
+
+# Stub for BEAST: writes the state file, records its start and end time and exits with the given status
+STUB = """import sys, time
+(mode, statefile, name, seconds, status) = sys.argv[1:]
+with open(name+".times", "a") as outfile:
+	outfile.write("%s\\t%f\\t" % (mode, time.time()))
+	open(statefile, "w").close()
+	time.sleep(float(seconds))
+	outfile.write("%f\\n" % time.time())
+sys.exit(int(status))
+"""
+
+
+def makeInput(path, names=["a", "b", "c"]):
+
+	for name in names:
+		open(os.path.join(path, name+".xml"), "w").close()
+	with open(os.path.join(path, "stub.py"), "w") as outfile:
+		outfile.write(STUB)
+#
+
+
+def runStub(path, seconds=0.3, status=0, args=[]):
+
+	command = "%s stub.py {mode} {statefile} {name} %s %d" % (sys.executable, seconds, status)
+	return subprocess.run([sys.executable, SCRIPT, "-i", str(path), "-s", "1", "-p", "0.05", "-C", command] + args,
+	                      check=True, capture_output=True, text=True).stdout
+#
+
+
+def readTimes(path, name):
+
+	with open(os.path.join(path, name+".times"), "r") as infile:
+		return [(fields[0], float(fields[1]), float(fields[2])) for fields in (line.split("\t") for line in infile)]
+#
+
+
+def readLogRows(path):
+
+	with open(os.path.join(path, "runbeast.csv"), "r") as infile:
+		return list(csv.DictReader(infile))
+#
+
+
+def overlaps(intervals):
+
+	intervals = sorted(intervals)
+	return any(intervals[i+1][0] < intervals[i][1] for i in range(0, len(intervals)-1))
+#
+
+
+def test_threads_budget(tmp_path):
+
+	makeInput(tmp_path)
+	runStub(tmp_path, args=["-c", "2", "-t", "2"])
+	assert not overlaps([readTimes(tmp_path, name+"_1")[0][1:] for name in ["a", "b", "c"]])
+#
+
+
+def test_memory_budget(tmp_path):
+
+	makeInput(tmp_path)
+	runStub(tmp_path, args=["-c", "8", "-t", "2", "-m", "3000", "-M", "4096"])
+	assert not overlaps([readTimes(tmp_path, name+"_1")[0][1:] for name in ["a", "b", "c"]])
+#
+
+
+def test_parallel_within_budget(tmp_path):
+
+	makeInput(tmp_path)
+	runStub(tmp_path, seconds=1, args=["-c", "6", "-t", "2", "-m", "1000", "-M", "4096"])
+	assert overlaps([readTimes(tmp_path, name+"_1")[0][1:] for name in ["a", "b", "c"]])
+#
+
+
+def test_resume_and_log(tmp_path):
+
+	makeInput(tmp_path, ["a"])
+
+	# Fails after writing the state file, so the second run resumes from it
+	runStub(tmp_path, seconds=0, status=1, args=["-t", "3", "-m", "1024"])
+	runStub(tmp_path, seconds=0, status=0, args=["-t", "3", "-m", "1024"])
+	assert [mode for (mode, start, end) in readTimes(tmp_path, "a_1")] == ["-overwrite", "-resume"]
+
+	rows = readLogRows(tmp_path)
+	assert [(row["xml"], row["seed"], row["threads"], row["memory"], row["mode"], row["status"]) for row in rows] == \
+	       [("a.xml", "1", "3", "1024", "-overwrite", "1"), ("a.xml", "1", "3", "1024", "-resume", "0")]
+	assert all(float(row["walltime"]) >= 0 and row["start"] != "" for row in rows)
+
+	# Finished jobs are skipped, unless forced to run from scratch
+	assert "Skipping 1 jobs" in runStub(tmp_path, seconds=0)
+	assert len(readTimes(tmp_path, "a_1")) == 2
+
+	runStub(tmp_path, seconds=0, args=["-f"])
+	assert readTimes(tmp_path, "a_1")[-1][0] == "-overwrite"
+	assert len(readLogRows(tmp_path)) == 3
+#
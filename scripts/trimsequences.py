@@ -2,7 +2,9 @@ import os, sys, time, csv
 import numpy as np
 from optparse import OptionParser
 from Bio import SeqIO, AlignIO
-from dropcolumns import dropcolumns
+from dropcolumns import dropcolumns, combineColumnMasks, resizeColumnMask, getMaskColumns
+from alignutils import readMSA, readAlignmentMatrix, writeFastaMatrix
+from msahist import getColumnHistogram, alphabet
 
 
 # Remove columns from alignment according to two criteria
@@ -13,6 +15,11 @@ from dropcolumns import dropcolumns
 # - All positions where more than a certain proportion of sequences have an unknown or ambiguous 
 #	assignment
 # - If an alignment file is provided the columns are directly trimmed from it
+# - With -F the histogram is computed directly from the alignment (no histogram file needed), 
+#	the alignment is only read once and trimmed sequences are written one at a time
+# - Several cutoffs can be evaluated at once, giving one output per cutoff
+# - Each criterion gives a boolean mask over the columns and the masks are combined by union 
+#	(default) or intersection
 #
 #
 ###################################################################################################
@@ -38,7 +45,7 @@ parser.add_option("-a","--alignfile",
                   dest = "alignfile",
                   default = "",
                   metavar = "path",
-                  help = "Path to input alignment file to extract sequences from [optional]")
+                  help = "Path to input alignment file (fasta or packed) to extract sequences from [optional]")
 
 parser.add_option("-o","--outputpath",
                   dest = "outputpath",
@@ -56,7 +63,7 @@ parser.add_option("-c","--cutoff",
                   dest = "cutoff",
                   default = "0.75",
                   metavar = "float",
-                  help = "Cutoff proportion for ambiguous columns [default: %default] [required]")
+                  help = "Cutoff proportion for ambiguous columns, or comma-separated list of cutoffs to write one output per cutoff [default: %default] [required]")
 
 parser.add_option("-m","--markedchar",
                   dest = "markedchar",
@@ -69,6 +76,17 @@ parser.add_option("-I","--inverse",
                   action = "store_true",
                   help = "Do the inverse (remove all but the selected columns) [default: %default] [optional]")
 
+parser.add_option("-F","--fused",
+                  dest = "fused",
+                  action = "store_true",
+                  help = "Compute the histogram from the alignment instead of reading a histogram file and trim in one pass (requires -a) [default: %default] [optional]")
+
+parser.add_option("-u","--combine",
+                  dest = "combine",
+                  default = "union",
+                  metavar = "union/intersection",
+                  help = "Select columns selected by any (union) or all (intersection) of the criteria [default: %default] [optional]")
+
 
 (options,args) = parser.parse_args()
 
@@ -78,52 +96,74 @@ alignfile  = os.path.abspath(options.alignfile) if options.alignfile != "" else
 outputpath = os.path.abspath(options.outputpath)+"/"
 prefix     = options.prefix
 markedchar = options.markedchar
-cutoff     = float(options.cutoff)
+cutoffs    = options.cutoff.split(",")
 inverse    = options.inverse
+combine    = options.combine
+fused      = options.fused
 
 ###################################################################################################	
 
 
-def getHistDropCols(msahist, checkchars=["N", "-"], cutoff=0.75):
-	"""Read histogram and return all columns in the alignment with a proportion > cutoff of 
-	sequences with one of checkchars at the site
+def readHistogram(msahist):
+	"""Read histogram csv file and return the column names and a (sites x characters) matrix
+
+	"""
+
+	with open(msahist, "r") as histfile:
+		colnames = next(csv.reader(histfile, delimiter=","))
+		histmat  = np.loadtxt(histfile, delimiter=",", ndmin=2)
+
+	return(colnames, histmat)
+#
+
+
+def getHistProportions(histmat, colnames, checkchars=["N", "-"]):
+	"""Return the proportion of sequences with one of checkchars at every site in the histogram
+
+	"""
+
+	charmask = np.array([c in checkchars for c in colnames], dtype=bool)
+
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return(histmat[:,charmask].sum(axis=1)/histmat.sum(axis=1))
+#
+
+
+def getHistDropMasks(histmat, colnames, checkchars=["N", "-"], cutoffs=[0.75]):
+	"""Return a (cutoffs x sites) matrix of masks of all sites with a proportion >= cutoff of 
+	sequences with one of checkchars at the site, for every cutoff at once
+
+	"""
+
+	props   = getHistProportions(histmat, colnames, checkchars)
+	cutoffs = np.asarray(cutoffs, dtype=float)
+
+	with np.errstate(invalid="ignore"):
+		return(props[np.newaxis,:] >= cutoffs[:,np.newaxis])
+#
+
+
+def getHistDropMask(msahist, checkchars=["N", "-"], cutoff=0.75):
+	"""Read histogram and return a mask of all columns in the alignment with a proportion > cutoff 
+	of sequences with one of checkchars at the site
 
 	"""
 
-	histfile = open(msahist, "r")
-	histraw  = list(csv.reader(histfile, delimiter=","))
-	colnames = histraw[0]
-	histmat  = np.array(histraw[1:]).astype("float")
-	dropcols = []
-
-	(rows, cols) = histmat.shape
-	for i in range(0,rows):
-		n = sum(histmat[i,])
-		count = 0
-		for j in range(0, cols):
-			if (colnames[j] in checkchars):
-				count += histmat[i,j]
-
-		prop = count/float(n)
-		if (prop >= cutoff):
-			dropcols.append(i)
-
-	return(dropcols)
+	(colnames, histmat) = readHistogram(msahist)
+
+	return(getHistDropMasks(histmat, colnames, checkchars, [cutoff])[0])
 #
 
 
-def getFastaDropCols(fastafile, checkchar="X"):
-	"""Read sequence from fastafile and return all sites marked with checkchar
+def getFastaDropMask(fastafile, checkchar="X"):
+	"""Read sequence from fastafile and return a mask of all sites marked with checkchar
 
 	"""
 
 	template = SeqIO.read(fastafile, "fasta")
-	dropcols = []
-	for i in range(0, len(template.seq)):
-		if (template.seq[i] == "X"):
-			dropcols.append(i)
+	seq      = np.frombuffer(str(template.seq).encode(), dtype=np.uint8)
 
-	return(dropcols)
+	return(seq == ord(checkchar))
 
 #
 
@@ -131,46 +171,79 @@ def getFastaDropCols(fastafile, checkchar="X"):
 
 start = time.time()
 
-dropcols = []
+templatemask = None
+histmasks    = None
+ambiguous    = ["R", "Y", "W", "S", "K", "M", "D", "V", "H", "B", "N", "-"]
+
+if (fused and alignfile == ""):
+	sys.stdout.write("ERROR! An alignment file is needed to compute the histogram (-F)\n")
+	raise RuntimeError
 
-# Read alignment histogram and find all positions with unknown/ambiguous > cutoff
-if (histfile != ""):
-	ambiguous = ["R", "Y", "W", "S", "K", "M", "D", "V", "H", "B", "N", "-"]
-	dropcols += getHistDropCols(histfile, checkchars=ambiguous, cutoff=cutoff)
+# Compute alignment histogram and find all positions with unknown/ambiguous > cutoff (for all cutoffs)
+if (fused):
+	(ids, matrix) = readAlignmentMatrix(alignfile)
+	histmat   = getColumnHistogram(matrix, verbose=False)
+	histmasks = getHistDropMasks(histmat, alphabet, checkchars=ambiguous, cutoffs=list(map(float, cutoffs)))
+
+# Read alignment histogram and find all positions with unknown/ambiguous > cutoff (for all cutoffs)
+elif (histfile != ""):
+	(colnames, histmat) = readHistogram(histfile)
+	histmasks = getHistDropMasks(histmat, colnames, checkchars=ambiguous, cutoffs=list(map(float, cutoffs)))
 
 # Read fasta sequence and find positions with "X"
 if (fastafile != ""):
-	dropcols += getFastaDropCols(fastafile, checkchar=markedchar)
-dropcols = sorted(set(dropcols))
+	templatemask = getFastaDropMask(fastafile, checkchar=markedchar)
 
-if (inverse): 
-	sys.stdout.write("%d columns found to keep in the alignment\n" % len(dropcols))	
-	fname = "kept"
-else: 
-	sys.stdout.write("%d columns found to trim from alignment\n" % len(dropcols))
-	fname = "dropped"
+if (histmasks is not None and templatemask is not None and histmasks.shape[1] != len(templatemask)):
+	sys.stdout.write("Warning: Criteria cover different numbers of columns (%d, %d)\n" % (histmasks.shape[1], len(templatemask)))
 
 # Save output
 if (not os.path.exists(outputpath)):
 	os.mkdir(outputpath)
 
-with open(outputpath+prefix+"."+fname+".csv","w") as f:
-    f.write(",".join(map(str, dropcols))+"\n")
-
-# Remove from alignment
-if (alignfile != ""):
-	msa = AlignIO.read(alignfile, "fasta")
-
-	if (inverse):
-		n = len(msa[0])
-		savecols = dropcols
-		dropcols = list(range(0,n))
-		for i in savecols:
-			dropcols.remove(i)
-
-	msa = dropcolumns(msa, dropcols, verbose=False)
-	AlignIO.write(msa, outputpath+prefix+".fas", "fasta")
-
+if (fused):
+	ncols = matrix.shape[1]
+elif (alignfile != ""):
+	msa   = readMSA(alignfile)
+	ncols = msa.get_alignment_length()
+
+sweep = (histmasks is not None and len(cutoffs) > 1)
+for i in range(0, len(cutoffs) if sweep else 1):
+
+	masks = []
+	if (histmasks is not None):
+		masks.append(histmasks[i])
+	if (templatemask is not None):
+		masks.append(templatemask)
+
+	selected = combineColumnMasks(masks, combine=combine)
+	selcols  = getMaskColumns(selected)
+	outname  = prefix+".c"+cutoffs[i] if sweep else prefix
+
+	if (sweep):
+		sys.stdout.write("Cutoff %s: " % cutoffs[i])
+
+	if (inverse): 
+		sys.stdout.write("%d columns found to keep in the alignment\n" % len(selcols))	
+		fname = "kept"
+	else: 
+		sys.stdout.write("%d columns found to trim from alignment\n" % len(selcols))
+		fname = "dropped"
+
+	with open(outputpath+outname+"."+fname+".csv","w") as f:
+	    f.write(",".join(map(str, selcols))+"\n")
+
+	# Remove from alignment
+	if (alignfile != ""):
+		dropmask = resizeColumnMask(selected, ncols)
+		if (inverse):
+			dropmask = ~dropmask
+
+		if (fused):
+			writeFastaMatrix(ids, matrix, outputpath+outname+".fas", keep=~dropmask)
+		else:
+			AlignIO.write(dropcolumns(msa, dropmask, verbose=False), outputpath+outname+".fas", "fasta")
+#
 
 end = time.time()
 sys.stdout.write("Total time taken: "+str(end-start)+" seconds\n")